@@ -0,0 +1,304 @@
+# COMO USAR:
+#   Rodar e salvar:      python bench_nfce.py --json bench_atual.json
+#   Comparar com antes:  python bench_nfce.py --json bench_atual.json --compare bench_anterior.json
+#   Só gerar o corpus:   python bench_nfce.py --generate-only --corpus F:\CORPUS_SINTETICO
+
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+from datetime import datetime, timedelta
+from pathlib import Path
+
+try:
+    import resource  # Unix
+except Exception:
+    resource = None
+
+import nfce_grafico as nf
+
+ITEM_COUNTS = (1, 10, 100, 1000)
+
+# =========================
+# Corpus sintético
+# =========================
+
+PRODUTOS = [
+    "ARROZ TIPO 1 5KG", "FEIJAO CARIOCA 1KG", "OLEO DE SOJA 900ML", "ACUCAR REFINADO 1KG",
+    "CAFE TORRADO E MOIDO 500G", "LEITE UHT INTEGRAL 1L", "MACARRAO ESPAGUETE 500G",
+    "DETERGENTE LIQUIDO NEUTRO 500ML", "SABAO EM PO MULTIACAO 1KG", "PAPEL HIGIENICO FOLHA DUPLA 12 ROLOS",
+    "REFRIGERANTE COLA 2L", "BISCOITO RECHEADO CHOCOLATE 140G", "BANANA PRATA KG", "TOMATE ITALIANO KG",
+]
+UNIDADES = ["UN", "KG", "CX", "PCT", "LT"]
+
+def chave_dv(chave43: str) -> str:
+    """Dígito verificador (módulo 11) da chave de acesso."""
+    total, peso = 0, 2
+    for d in reversed(chave43):
+        total += int(d) * peso
+        peso = 2 if peso == 9 else peso + 1
+    dv = 11 - (total % 11)
+    return "0" if dv >= 10 else str(dv)
+
+def make_chave(cnpj: str, dh: datetime, serie: int, nnf: int, cnf: int) -> str:
+    ch = f"35{dh:%y%m}{cnpj}65{serie:03d}{nnf:09d}1{cnf:08d}"
+    return ch + chave_dv(ch)
+
+def generate_nfce_xml(seq: int, n_items: int, with_qr: bool = True, tpags=("01",), proc: bool = True,
+                      rnd: random.Random | None = None) -> str:
+    """
+    Gera o XML (texto) de uma NFC-e sintética, plausível para o schema 4.00:
+    emitente, consumidor, `n_items` det, totais, pagamentos e (opcional) QR.
+    """
+    rnd = rnd or random.Random(seq)
+    cnpj = "12345678000199"
+    dh = datetime(2025, 7, 1, 8, 0, 0) + timedelta(minutes=7 * seq)
+    chave = make_chave(cnpj, dh, 1, seq + 1, rnd.randrange(10**8))
+
+    dets, v_prod = [], 0
+    for k in range(n_items):
+        q = rnd.choice([1, 1, 1, 2, 3]) if rnd.random() < 0.8 else round(rnd.uniform(0.1, 3), 3)
+        vu = round(rnd.uniform(0.5, 80), 2)
+        vp = round(q * vu, 2)
+        v_prod += vp
+        desc = rnd.choice(PRODUTOS)
+        dets.append(
+            f'<det nItem="{k+1}"><prod><cProd>{rnd.randrange(10**6, 10**7)}</cProd><cEAN>SEM GTIN</cEAN>'
+            f'<xProd>{desc}</xProd><NCM>19059090</NCM><CFOP>5102</CFOP><uCom>{rnd.choice(UNIDADES)}</uCom>'
+            f'<qCom>{q:.4f}</qCom><vUnCom>{vu:.10f}</vUnCom><vProd>{vp:.2f}</vProd><cEANTrib>SEM GTIN</cEANTrib>'
+            f'<uTrib>UN</uTrib><qTrib>{q:.4f}</qTrib><vUnTrib>{vu:.10f}</vUnTrib><indTot>1</indTot></prod>'
+            f'<imposto><ICMS><ICMSSN102><orig>0</orig><CSOSN>102</CSOSN></ICMSSN102></ICMS></imposto></det>'
+        )
+    v_prod = round(v_prod, 2)
+    v_desc = round(v_prod * 0.02, 2) if seq % 3 == 0 else 0.0
+    v_nf = round(v_prod - v_desc, 2)
+
+    # Divide o valor entre os meios de pagamento; o último cobre o restante (+ troco em dinheiro)
+    pags, restante = [], v_nf
+    for i, tp in enumerate(tpags):
+        v = restante if i == len(tpags) - 1 else round(v_nf / len(tpags), 2)
+        restante = round(restante - v, 2)
+        troco_pag = 5.0 if tp == "01" and i == len(tpags) - 1 else 0.0
+        x_pag = "<xPag>Carteira</xPag>" if tp == "90" else ""
+        pags.append(f"<detPag><tPag>{tp}</tPag>{x_pag}<vPag>{v + troco_pag:.2f}</vPag></detPag>")
+    v_troco = "<vTroco>5.00</vTroco>" if tpags[-1] == "01" else ""
+
+    supl = ""
+    if with_qr:
+        supl = (f"<infNFeSupl><qrCode><![CDATA[https://www.nfce.fazenda.sp.gov.br/NFCeConsultaPublica/Paginas/"
+                f"ConsultaQRCode.aspx?p={chave}|2|1|1|{rnd.getrandbits(160):040X}]]></qrCode>"
+                f"<urlChave>https://www.nfce.fazenda.sp.gov.br/consulta</urlChave></infNFeSupl>")
+
+    nfe = (
+        f'<NFe xmlns="http://www.portalfiscal.inf.br/nfe"><infNFe Id="NFe{chave}" versao="4.00">'
+        f'<ide><cUF>35</cUF><cNF>{chave[35:43]}</cNF><natOp>VENDA</natOp><mod>65</mod><serie>1</serie>'
+        f'<nNF>{seq + 1}</nNF><dhEmi>{dh:%Y-%m-%dT%H:%M:%S}-03:00</dhEmi><tpNF>1</tpNF><tpImp>4</tpImp>'
+        f'<tpEmis>1</tpEmis><cDV>{chave[-1]}</cDV><tpAmb>1</tpAmb><finNFe>1</finNFe></ide>'
+        f'<emit><CNPJ>{cnpj}</CNPJ><xNome>SUPERMERCADO SINTETICO LTDA</xNome><xFant>MERCADO SINTETICO</xFant>'
+        f'<enderEmit><xLgr>AV PAULISTA</xLgr><nro>1000</nro><xBairro>BELA VISTA</xBairro><cMun>3550308</cMun>'
+        f'<xMun>SAO PAULO</xMun><UF>SP</UF><CEP>01310100</CEP></enderEmit><IE>111222333444</IE><CRT>1</CRT></emit>'
+        + (f'<dest><CPF>{rnd.randrange(10**10, 10**11)}</CPF><xNome>CONSUMIDOR {seq}</xNome></dest>' if seq % 2 else "")
+        + "".join(dets)
+        + f'<total><ICMSTot><vBC>0.00</vBC><vICMS>0.00</vICMS><vProd>{v_prod:.2f}</vProd><vDesc>{v_desc:.2f}</vDesc>'
+          f'<vOutro>0.00</vOutro><vNF>{v_nf:.2f}</vNF></ICMSTot></total>'
+          f'<transp><modFrete>9</modFrete></transp><pag>{"".join(pags)}{v_troco}</pag>'
+          f'</infNFe>{supl}</NFe>'
+    )
+    if not proc:
+        return '<?xml version="1.0" encoding="UTF-8"?>' + nfe
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><nfeProc xmlns="http://www.portalfiscal.inf.br/nfe" versao="4.00">'
+        + nfe
+        + f'<protNFe versao="4.00"><infProt><tpAmb>1</tpAmb><chNFe>{chave}</chNFe>'
+          f'<dhRecbto>{dh:%Y-%m-%dT%H:%M:%S}-03:00</dhRecbto><nProt>1352500000{seq:05d}</nProt>'
+          f'<cStat>100</cStat><xMotivo>Autorizado o uso da NF-e</xMotivo></infProt></protNFe></nfeProc>'
+    )
+
+def generate_corpus(out_dir: Path, item_counts=ITEM_COUNTS, copies: int = 3, seed: int = 42):
+    """
+    Gera o corpus: para cada quantidade de itens, com e sem qrCode, `copies`
+    arquivos, alternando os meios de pagamento de TPAG_MAP. Retorna
+    [(caminho, n_itens)].
+    """
+    rnd = random.Random(seed)
+    codes = sorted(nf.TPAG_MAP)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    files, seq = [], 0
+    for n_items in item_counts:
+        for with_qr in (True, False):
+            for _ in range(copies):
+                tpags = tuple(rnd.sample(codes, rnd.choice([1, 1, 2])))
+                xml = generate_nfce_xml(seq, n_items, with_qr=with_qr, tpags=tpags, proc=seq % 2 == 0,
+                                        rnd=random.Random(rnd.random()))
+                p = out_dir / f"nfce_{n_items:04d}itens_{'qr' if with_qr else 'semqr'}_{seq:05d}.xml"
+                p.write_text(xml, encoding="utf-8")
+                files.append((p, n_items))
+                seq += 1
+    return files
+
+# =========================
+# Medição
+# =========================
+
+def peak_rss_mb(children: bool = False):
+    """
+    Pico de memória residente (MB) do processo (ou dos filhos), se disponível.
+    É o pico da execução inteira até aqui, não de uma etapa: por isso só é
+    lido uma vez, ao final do benchmark.
+    """
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux informa em KB; macOS em bytes
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def summarize(latencies, wall, n_files):
+    return {
+        "files": n_files,
+        "wall_s": round(wall, 4),
+        "files_per_sec": round(n_files / wall, 2) if wall > 0 else None,
+        "p50_ms": round(nf.percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "p99_ms": round(nf.percentile(latencies, 99) * 1000, 3) if latencies else None,
+    }
+
+def time_per_file(fn, files):
+    lat = []
+    t0 = time.perf_counter()
+    for p, _ in files:
+        t = time.perf_counter()
+        fn(p)
+        lat.append(time.perf_counter() - t)
+    return lat, time.perf_counter() - t0
+
+def run_benchmark(corpus: Path, files, work: Path, paper: str = "A4", workers: int | None = None):
+    stages = {}
+
+    # make_pdf (por arquivo, inclui parse) + quebra por quantidade de itens
+    pdf_dir = work / "make_pdf"
+    pdf_dir.mkdir(parents=True, exist_ok=True)
+    lat, wall = time_per_file(lambda p: nf.make_pdf(str(p), str(pdf_dir / f"{p.stem}.pdf"), paper=paper), files)
+    stages["make_pdf"] = summarize(lat, wall, len(files))
+    by_items = {}
+    for (p, n_items), t in zip(files, lat):
+        by_items.setdefault(n_items, []).append(t)
+    stages["make_pdf"]["by_items"] = {
+        str(n): {"p50_ms": round(nf.percentile(ts, 50) * 1000, 3), "p99_ms": round(nf.percentile(ts, 99) * 1000, 3)}
+        for n, ts in sorted(by_items.items())
+    }
+
+    # parse_items_for_excel
+    rows = []
+    lat, wall = time_per_file(lambda p: rows.extend(nf.parse_items_for_excel(p)), files)
+    stages["parse_items_for_excel"] = summarize(lat, wall, len(files))
+
+    # read_meta com totais (o que o --dry-run lê de cada XML)
+    lat, wall = time_per_file(lambda p: nf.read_meta(p, totals=True), files)
+    stages["read_meta"] = summarize(lat, wall, len(files))
+
+    # export_excel (um único arquivo com todas as linhas)
+    t = time.perf_counter()
+    nf.export_excel(rows, work / "itens.xlsx")
+    wall = time.perf_counter() - t
+    stages["export_excel"] = summarize([], wall, len(files))
+    stages["export_excel"]["rows"] = len(rows)
+    stages["export_excel"]["rows_per_sec"] = round(len(rows) / wall, 1) if wall > 0 else None
+
+    # process_directory (lote completo, com Excel)
+    out_dir = work / "process_directory"
+    t = time.perf_counter()
+    ok, fail, total = nf.process_directory(corpus, out_dir, paper, "*.xml", False,
+                                           excel_path=out_dir / "itens.xlsx", workers=workers)
+    wall = time.perf_counter() - t
+    stages["process_directory"] = summarize([], wall, total)
+    stages["process_directory"].update({
+        "ok": ok, "fail": fail, "workers": workers or nf.default_workers(),
+    })
+    return stages
+
+def compare(current, previous, threshold):
+    """Imprime a variação por etapa; retorna True se alguma piorou além do limite."""
+    regressed = False
+    print(f"\n{'etapa':<24}{'arq/s antes':>14}{'arq/s agora':>14}{'variação':>10}")
+    for stage, cur in current["stages"].items():
+        prev = previous.get("stages", {}).get(stage)
+        if not prev or not prev.get("files_per_sec") or not cur.get("files_per_sec"):
+            continue
+        delta = cur["files_per_sec"] / prev["files_per_sec"] - 1
+        flag = ""
+        if delta < -threshold:
+            regressed = True
+            flag = "  << REGRESSÃO"
+        print(f"{stage:<24}{prev['files_per_sec']:>14.2f}{cur['files_per_sec']:>14.2f}{delta:>+10.1%}{flag}")
+    return regressed
+
+# =========================
+# CLI
+# =========================
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark do conversor NFC-e (corpus sintético, tempos por etapa).")
+    ap.add_argument("--corpus", help="Diretório do corpus (padrão: temporário, gerado e apagado ao final)")
+    ap.add_argument("--items", default=",".join(map(str, ITEM_COUNTS)), help="Quantidades de itens (padrão: 1,10,100,1000)")
+    ap.add_argument("--copies", type=int, default=3, help="Arquivos por combinação itens x QR (padrão: 3)")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--paper", default="A4", help="A4 ou 80mm (padrão: A4)")
+    ap.add_argument("--workers", type=int, default=None, help="Processos do process_directory (padrão: nº de núcleos)")
+    ap.add_argument("--json", help="Salva os resultados neste arquivo JSON")
+    ap.add_argument("--compare", help="JSON de uma execução anterior para comparar")
+    ap.add_argument("--threshold", type=float, default=0.10, help="Queda de arq/s que conta como regressão (padrão: 0.10)")
+    ap.add_argument("--generate-only", action="store_true", help="Só gera o corpus em --corpus e sai")
+    args = ap.parse_args()
+    if args.generate_only and not args.corpus:
+        ap.error("--generate-only requer --corpus (sem ele o corpus iria para um diretório temporário, apagado ao final)")
+
+    item_counts = tuple(int(x) for x in args.items.split(",") if x.strip())
+    tmp = Path(tempfile.mkdtemp(prefix="bench_nfce_"))
+    corpus = Path(args.corpus) if args.corpus else tmp / "corpus"
+    try:
+        files = generate_corpus(corpus, item_counts, args.copies, args.seed)
+        print(f"Corpus: {len(files)} XML(s) em {corpus}")
+        if args.generate_only:
+            return
+        stages = run_benchmark(corpus, files, tmp / "saida", paper=args.paper, workers=args.workers)
+        result = {
+            "meta": {
+                "timestamp": datetime.now().isoformat(timespec="seconds"),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "paper": args.paper,
+                "items": list(item_counts),
+                "copies": args.copies,
+                "seed": args.seed,
+            },
+            "stages": stages,
+            # Pico da execução inteira: as etapas rodam no mesmo processo
+            "peak_rss_mb": peak_rss_mb(),
+            "peak_rss_children_mb": peak_rss_mb(children=True),
+        }
+        for stage, r in stages.items():
+            p50 = f"{r['p50_ms']:.1f} ms" if r.get("p50_ms") is not None else "-"
+            p99 = f"{r['p99_ms']:.1f} ms" if r.get("p99_ms") is not None else "-"
+            print(f"{stage:<24}{r['files_per_sec']:>10} arq/s   p50 {p50:>10}   p99 {p99:>10}")
+        print(f"Pico de RSS: {result['peak_rss_mb']} MB (processo), {result['peak_rss_children_mb']} MB (workers)")
+        if args.json:
+            Path(args.json).write_text(json.dumps(result, indent=2, ensure_ascii=False), encoding="utf-8")
+            print(f"Resultados salvos em {args.json}")
+        if args.compare:
+            previous = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+            if compare(result, previous, args.threshold):
+                sys.exit(1)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -10,11 +10,40 @@ import io
 import os
 import sys
 import math
+import queue
+import time
+import csv
+import json
+import hashlib
 import argparse
+import select
+import shutil
+import signal
+import socket
+import sqlite3
+import struct
+import tarfile
+import textwrap
 import threading
+import weakref
+import zipfile
+import ctypes
+import ctypes.util
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass
+from fnmatch import fnmatch
+from functools import lru_cache
+from itertools import islice
+from typing import NamedTuple
 from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime
-from pathlib import Path
+from email import policy as email_policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path, PurePosixPath
+from urllib.parse import parse_qs, urlparse
 
 from lxml import etree as ET  # lxml facilita com namespaces
 from reportlab.pdfgen import canvas
@@ -24,14 +53,21 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 
 import qrcode
-from reportlab.lib.utils import ImageReader
 
-# ---- Excel (pandas) ----
+# ---- Excel (openpyxl) ----
 try:
-    import pandas as pd
-    PANDAS_AVAILABLE = True
+    from openpyxl import Workbook, load_workbook
+    OPENPYXL_AVAILABLE = True
 except Exception:
-    PANDAS_AVAILABLE = False
+    OPENPYXL_AVAILABLE = False
+
+# ---- Parquet (pyarrow, opcional) ----
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except Exception:
+    PYARROW_AVAILABLE = False
 
 # --- GUI (Tkinter) ---
 try:
@@ -54,10 +90,23 @@ def dec(v):
         return v
     return Decimal(str(v)).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
+# troca "," <-> "." numa única passada (formato en-US -> pt-BR)
+_BR_DIGITS = str.maketrans(",.", ".,")
+
 def br_currency(v):
     # formata 1234.5 -> '1.234,50'
-    s = f"{dec(v):,.2f}"
-    return s.replace(",", "X").replace(".", ",").replace("X", ".")
+    return f"{dec(v):,.2f}".translate(_BR_DIGITS)
+
+# Os itens repetem os mesmos valores (preço unitário, quantidade 1) em todo
+# cupom: as versões para texto do XML ficam em cache.
+@lru_cache(maxsize=4096)
+def br_money_text(v: str) -> str:
+    return br_currency(v)
+
+@lru_cache(maxsize=4096)
+def br_qty_text(v: str) -> str:
+    # quantidade com 4 casas: '1.5' -> '1,5000'
+    return f"{Decimal(v or '0'):,.4f}".translate(_BR_DIGITS)
 
 def get_text(node, xpath):
     if node is None:
@@ -69,25 +118,46 @@ def get_dec(node, xpath):
     t = get_text(node, xpath)
     return dec(t) if t else Decimal("0.00")
 
-def wrap_text(c, text, x, y, width, line_height, max_lines=None, fontname="Helvetica", fontsize=9):
-    c.setFont(fontname, fontsize)
-    words = text.split()
-    lines, cur = [], ""
-    for w in words:
-        test = (cur + " " + w).strip()
-        if c.stringWidth(test, fontname, fontsize) <= width:
-            cur = test
-        else:
-            lines.append(cur)
-            cur = w
+WRAP_CACHE_SIZE = 8192
+
+@lru_cache(maxsize=WRAP_CACHE_SIZE)
+def wrap_lines(text, width, fontname="Helvetica", fontsize=9):
+    """
+    Quebra `text` em linhas que caibam em `width` e devolve a tupla de linhas.
+    Cada palavra é medida uma vez e a largura da linha é acumulada (em vez
+    de medir o prefixo inteiro a cada palavra). As descrições se repetem
+    muito entre cupons (mesmos produtos em todas as lojas), daí o cache.
+    """
+    space_w = pdfmetrics.stringWidth(" ", fontname, fontsize)
+    lines, cur, cur_w = [], "", 0.0
+    for w in text.split():
+        w_w = pdfmetrics.stringWidth(w, fontname, fontsize)
+        if not cur:
+            if w_w <= width:
+                cur, cur_w = w, w_w
+                continue
+        elif cur_w + space_w + w_w <= width:
+            cur, cur_w = f"{cur} {w}", cur_w + space_w + w_w
+            continue
+        lines.append(cur)
+        cur, cur_w = w, w_w
     if cur:
         lines.append(cur)
-    if max_lines is not None:
-        lines = lines[:max_lines]
+    return tuple(lines)
+
+def draw_lines(c, lines, x, y, line_height):
+    """Desenha linhas já quebradas (fonte já definida no canvas)."""
     for i, line in enumerate(lines):
         c.drawString(x, y - i*line_height, line)
     return y - (len(lines) * line_height), len(lines)
 
+def wrap_text(c, text, x, y, width, line_height, max_lines=None, fontname="Helvetica", fontsize=9):
+    c.setFont(fontname, fontsize)
+    lines = wrap_lines(text, width, fontname, fontsize)
+    if max_lines is not None:
+        lines = lines[:max_lines]
+    return draw_lines(c, lines, x, y, line_height)
+
 # Mapas de pagamento (NTs da NFC-e)
 TPAG_MAP = {
     "01": "Dinheiro",
@@ -111,107 +181,760 @@ def format_chave(ch):
     d = "".join([c for c in ch if c.isdigit()])
     return " ".join([d[i:i+4] for i in range(0, len(d), 4)])
 
+# =========================
+# Modelo NFC-e (parse único)
+# =========================
+
+@dataclass(frozen=True)
+class Endereco:
+    xLgr: str
+    nro: str
+    xBairro: str
+    xMun: str
+    UF: str
+    CEP: str
+
+@dataclass(frozen=True)
+class Emitente:
+    xNome: str
+    xFant: str
+    CNPJ: str
+    IE: str
+    ender: Endereco | None
+
+@dataclass(frozen=True)
+class Consumidor:
+    xNome: str
+    doc: str  # CPF ou CNPJ
+
+@dataclass(frozen=True)
+class Item:
+    cProd: str
+    xProd: str
+    qCom: str
+    uCom: str
+    vUnCom: str
+    vProd: str
+
+@dataclass(frozen=True)
+class Totais:
+    vProd: Decimal
+    vDesc: Decimal
+    vOutro: Decimal
+    vNF: Decimal
+
+@dataclass(frozen=True)
+class Pagamento:
+    tPag: str
+    xPag: str
+    vPag: Decimal
+
+@dataclass(frozen=True)
+class Pagamentos:
+    detalhes: tuple
+    vTroco: Decimal
+
+@dataclass(frozen=True)
+class NFCe:
+    """
+    Representação imutável de uma NFC-e, montada uma única vez por arquivo.
+    É a fonte de dados comum do PDF, da chave de acesso e do Excel.
+    """
+    chave: str
+    dhEmi: str
+    dhEmi_str: str
+    emit: Emitente
+    dest: Consumidor
+    itens: tuple
+    totais: Totais
+    pag: Pagamentos | None
+    qr_url: str
+    proc: bool = False  # veio no envelope nfeProc (com protocolo de autorização)
+
+def format_dhEmi(dhEmi: str) -> str:
+    if not dhEmi:
+        return ""
+    try:
+        dt = datetime.fromisoformat(dhEmi)  # 2025-07-15T15:33:21-03:00
+        return dt.strftime("%d/%m/%Y %H:%M:%S")
+    except Exception:
+        return dhEmi
+
+def find_nfe(root):
+    nfe = root.find("nfe:NFe", NS)
+    if nfe is None and root.tag.endswith("NFe"):
+        nfe = root
+    return nfe
+
+# -------------------------
+# Parser XML (um por processo/thread, endurecido)
+# -------------------------
+
+XML_HUGE_TREE = False  # --huge-tree: libera os limites do libxml2 (cupons gigantes)
+_parsers = threading.local()
+
+def configure_parser(huge_tree: bool = False):
+    """Define as opções do parser; vale para os próximos parsers criados."""
+    global XML_HUGE_TREE
+    if bool(huge_tree) != XML_HUGE_TREE:
+        XML_HUGE_TREE = bool(huge_tree)
+        _parsers.__dict__.clear()
+
+def xml_parser():
+    """
+    XMLParser reaproveitado (um por thread: o lxml não compartilha parser
+    entre threads). Sem entidades, DTD ou rede, então XML malicioso não lê
+    arquivos locais nem faz requisições; espaços entre tags são descartados
+    na montagem da árvore.
+    """
+    parser = getattr(_parsers, "parser", None)
+    if parser is None:
+        parser = _parsers.parser = ET.XMLParser(
+            remove_blank_text=True, resolve_entities=False, no_network=True,
+            load_dtd=False, huge_tree=XML_HUGE_TREE,
+        )
+    return parser
+
+def parse_xml(source):
+    """Raiz do XML: caminho, ArchiveMember ou bytes, sempre com xml_parser()."""
+    if isinstance(source, ArchiveMember):
+        return ET.fromstring(source.data, xml_parser(), base_url=str(source))
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return ET.fromstring(bytes(source), xml_parser())
+    return ET.parse(str(source), xml_parser()).getroot()
+
+# Tags com namespace já resolvidas: a extração compara tags dos filhos
+# diretos numa única passada, em vez de um find() por campo.
+_NFE = f"{{{NS['nfe']}}}"
+_T_INF = _NFE + "infNFe"
+_T_DET, _T_PROD, _T_ICMSTOT, _T_DETPAG = _NFE + "det", _NFE + "prod", _NFE + "ICMSTot", _NFE + "detPag"
+_XP_CHNFE = ET.XPath("//nfe:protNFe/nfe:infProt/nfe:chNFe/text()", namespaces=NS)
+
+def child_map(el) -> dict:
+    """Filhos diretos de el por nome local (o primeiro de cada nome)."""
+    out = {}
+    if el is None:
+        return out
+    for ch in el:
+        tag = ch.tag
+        if isinstance(tag, str):
+            out.setdefault(tag[len(_NFE):] if tag.startswith(_NFE) else tag, ch)
+    return out
+
+def child_texts(el) -> dict:
+    """Texto (sem espaços nas pontas) dos filhos diretos de el, por nome local."""
+    return {k: (ch.text or "").strip() for k, ch in child_map(el).items()}
+
+def _dec_or_zero(t: str) -> Decimal:
+    return dec(t) if t else Decimal("0.00")
+
+def nfce_from_root(root) -> NFCe:
+    """Monta o modelo NFCe a partir da raiz (NFe ou nfeProc) já parseada."""
+    nfe = find_nfe(root)
+    parts = child_map(nfe)
+    inf = parts.get("infNFe")
+    infSupl = parts.get("infNFeSupl")
+
+    # uma passada pelos filhos de infNFe (ide, emit, dest, det..., total, pag)
+    blocks, dets = {}, []
+    if inf is not None:
+        for ch in inf:
+            if ch.tag == _T_DET:
+                dets.append(ch)
+            elif isinstance(ch.tag, str):
+                blocks.setdefault(ch.tag[len(_NFE):], ch)
+    emit = blocks.get("emit")
+    e = child_texts(emit)
+    ender_el = child_map(emit).get("enderEmit")
+    endereco = None
+    if ender_el is not None:
+        a = child_texts(ender_el)
+        endereco = Endereco(
+            xLgr=a.get("xLgr", ""),
+            nro=a.get("nro", ""),
+            xBairro=a.get("xBairro", ""),
+            xMun=a.get("xMun", ""),
+            UF=a.get("UF", ""),
+            CEP=a.get("CEP", ""),
+        )
+    emitente = Emitente(
+        xNome=e.get("xNome", ""),
+        xFant=e.get("xFant", ""),
+        CNPJ=e.get("CNPJ", ""),
+        IE=e.get("IE", ""),
+        ender=endereco,
+    )
+    d = child_texts(blocks.get("dest"))
+    consumidor = Consumidor(
+        xNome=d.get("xNome", ""),
+        doc=d.get("CPF") or d.get("CNPJ", ""),
+    )
+
+    itens = []
+    for det in dets:
+        prod = det.find(_T_PROD)
+        if prod is None:
+            continue
+        # laço mais interno do parse: uma passada pelos filhos de prod
+        f = {}
+        for ch in prod:
+            f[ch.tag] = ch.text
+        itens.append(Item(
+            cProd=(f.get(_NFE + "cProd") or "").strip(),
+            xProd=(f.get(_NFE + "xProd") or "").strip(),
+            qCom=(f.get(_NFE + "qCom") or "").strip(),
+            uCom=(f.get(_NFE + "uCom") or "").strip(),
+            vUnCom=(f.get(_NFE + "vUnCom") or "").strip(),
+            vProd=(f.get(_NFE + "vProd") or "").strip(),
+        ))
+
+    total_el = blocks.get("total")
+    t = child_texts(total_el.find(_T_ICMSTOT) if total_el is not None else None)
+    totais = Totais(
+        vProd=_dec_or_zero(t.get("vProd")),
+        vDesc=_dec_or_zero(t.get("vDesc")),
+        vOutro=_dec_or_zero(t.get("vOutro")),
+        vNF=_dec_or_zero(t.get("vNF")),
+    )
+
+    pagamentos = None
+    pag = blocks.get("pag")
+    if pag is not None:
+        detalhes = []
+        for dp in pag.iterchildren(_T_DETPAG):
+            p = child_texts(dp)
+            detalhes.append(Pagamento(
+                tPag=p.get("tPag", ""),
+                xPag=p.get("xPag", ""),
+                vPag=_dec_or_zero(p.get("vPag")),
+            ))
+        pagamentos = Pagamentos(
+            detalhes=tuple(detalhes),
+            vTroco=_dec_or_zero(child_texts(pag).get("vTroco")),
+        )
+
+    dhEmi = child_texts(blocks.get("ide")).get("dhEmi", "")
+    return NFCe(
+        chave=robust_extract_chave(root, inf),
+        dhEmi=dhEmi,
+        dhEmi_str=format_dhEmi(dhEmi),
+        emit=emitente,
+        dest=consumidor,
+        itens=tuple(itens),
+        totais=totais,
+        pag=pagamentos,
+        qr_url=child_texts(infSupl).get("qrCode", ""),
+        proc=root.tag.endswith("nfeProc"),
+    )
+
+def load_nfce(xml_path) -> NFCe:
+    """Lê e parseia o XML uma única vez, devolvendo o modelo NFCe."""
+    return nfce_from_root(parse_xml(xml_path))
+
+def robust_extract_chave(root, inf=None) -> str:
+    """
+    Tenta extrair a chave de acesso da NFC-e a partir de:
+    - infNFe/@Id
+    - nfeProc/protNFe/infProt/chNFe
+    Retorna apenas dígitos (até 44). `inf`: infNFe já localizado, se houver.
+    """
+    chave = ""
+    if inf is None:
+        nfe = find_nfe(root)
+        inf = nfe.find(_T_INF) if nfe is not None else None
+    if inf is not None:
+        chave = (inf.get("Id") or "").replace("NFe", "")
+    if not chave:
+        ch = _XP_CHNFE(root)
+        if ch:
+            chave = ch[0].strip()
+    return chave_digits(chave)
+
+def chave_digits(s) -> str:
+    """Só os dígitos da chave (até 44)."""
+    return "".join([c for c in (s or "") if c.isdigit()])[:44]
+
+# -------------------------
+# Metadados rápidos (sem montar o modelo)
+# -------------------------
+
+@dataclass(frozen=True, slots=True)
+class NFCeMeta:
+    """Chave, emissão, CNPJ do emitente e (opcional) vNF, lidos por read_meta."""
+    chave: str
+    dhEmi: str
+    CNPJ: str
+    vNF: Decimal | None
+    proc: bool  # XML de distribuição (nfeProc: NFe + protocolo de autorização)
+
+    @property
+    def dhEmi_str(self) -> str:
+        return format_dhEmi(self.dhEmi)
+
+# Só estes elementos geram eventos (o filtro roda no libxml2, não no Python)
+_META_TAGS = tuple(f"{{{NS['nfe']}}}{t}" for t in ("nfeProc", "infNFe", "dhEmi", "CNPJ", "det", "total"))
+_META_TAGS_TOTALS = tuple(f"{{{NS['nfe']}}}{t}" for t in ("nfeProc", "infNFe", "dhEmi", "CNPJ", "det", "vNF"))
+META_BLOCK = 16 * 1024
+# Com totals=True, a árvore inteira (parse de uma vez pelo libxml2) é ~2x
+# mais rápida que o parse incremental, mas ocupa ~11x o tamanho do XML;
+# acima deste tamanho, o parse incremental (memória constante) compensa.
+META_STREAM_MIN = 1024 * 1024
+
+def _iter_blocks(source):
+    if isinstance(source, ArchiveMember):
+        source = source.data
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        data = bytes(source)
+        for i in range(0, len(data), META_BLOCK):
+            yield data[i:i + META_BLOCK]
+        return
+    with open(source, "rb") as f:
+        yield from iter(lambda: f.read(META_BLOCK), b"")
+
+def _read_head(source, totals: bool = False):
+    """
+    Cabeçalho por parse incremental: lê o XML em blocos e para no primeiro
+    item (ou nos totais), então o custo não depende do tamanho do cupom.
+    Com totals=True segue até total/ICMSTot/vNF, descartando cada item já
+    lido, e para ali (pagamentos, assinatura e protocolo não são lidos).
+    Retorna (chave, dhEmi, CNPJ, nfeProc, vNF ou None).
+    """
+    parser = ET.XMLPullParser(events=("start", "end"), tag=_META_TAGS_TOTALS if totals else _META_TAGS,
+                              resolve_entities=False, no_network=True, huge_tree=XML_HUGE_TREE)
+    chave = dhEmi = cnpj = ""
+    proc = False
+    for block in _iter_blocks(source):
+        parser.feed(block)
+        for event, el in parser.read_events():
+            name = el.tag.rpartition("}")[2]
+            if event == "start":
+                if name in ("det", "total") and not totals:
+                    return chave, dhEmi, cnpj, proc, None
+                if name == "nfeProc":
+                    proc = True
+                elif name == "infNFe":
+                    chave = chave_digits(el.get("Id"))
+            elif name == "det":
+                # item já passou: libera a memória (cupons com milhares de itens)
+                el.clear()
+                while el.getprevious() is not None:
+                    del el.getparent()[0]
+            elif name == "vNF" and el.getparent().tag == _T_ICMSTOT:
+                t = (el.text or "").strip()
+                return chave, dhEmi, cnpj, proc, dec(t) if t else Decimal("0.00")
+            elif name == "dhEmi":
+                dhEmi = (el.text or "").strip()
+            elif name == "CNPJ" and el.getparent().tag.endswith("}emit"):
+                cnpj = (el.text or "").strip()
+    parser.close()  # documento sem itens (ou sem totais): valida o final
+    return chave, dhEmi, cnpj, proc, Decimal("0.00") if totals else None
+
+def _source_size(source) -> int:
+    if isinstance(source, ArchiveMember):
+        return len(source.data)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return len(source)
+    try:
+        return os.path.getsize(source)
+    except OSError:
+        return 0  # o parse da árvore reporta o erro
+
+def read_meta(source, totals: bool = True) -> NFCeMeta:
+    """
+    Metadados sem montar o modelo nem renderizar. `source`: caminho,
+    ArchiveMember ou bytes; erros de XML são propagados.
+
+    totals=False: parse incremental (_read_head) que para no primeiro item
+    (chave, dhEmi, CNPJ e nfeProc), em tempo constante mesmo em cupons
+    enormes. totals=True: o vNF fica depois de todos os itens; até
+    META_STREAM_MIN a árvore é montada de uma vez (mais rápido), acima
+    dele o parse incremental segue até o vNF com memória limitada. Quando
+    falta infNFe/@Id, a árvore é sempre montada: a chave então está no
+    protocolo, no fim do nfeProc.
+    """
+    if not totals or _source_size(source) >= META_STREAM_MIN:
+        chave, dhEmi, cnpj, proc, vnf = _read_head(source, totals)
+        if chave or not proc:
+            return NFCeMeta(chave, dhEmi, cnpj, vnf, proc)
+    root = parse_xml(source)
+    nfe = find_nfe(root)
+    inf = nfe.find(_T_INF) if nfe is not None else None
+    vnf = None
+    if totals:
+        t = get_text(inf, "nfe:total/nfe:ICMSTot/nfe:vNF")
+        vnf = dec(t) if t else Decimal("0.00")
+    return NFCeMeta(
+        chave=robust_extract_chave(root),
+        dhEmi=get_text(inf, "nfe:ide/nfe:dhEmi"),
+        CNPJ=get_text(inf, "nfe:emit/nfe:CNPJ"),
+        vNF=vnf,
+        proc=root.tag.endswith("}nfeProc"),
+    )
+
+# =========================
+# Fontes (registro único por processo)
+# =========================
+
+DEFAULT_FONT = "DejaVuSans.ttf"
+DEFAULT_FONT_BOLD = "DejaVuSans-Bold.ttf"
+FALLBACK_FONTS = ("Helvetica", "Helvetica-Bold")
+
+_font_config = {"regular": None, "bold": None}
+_font_pair = None
+_font_lock = threading.Lock()
+
+def configure_fonts(regular=None, bold=None):
+    """
+    Define os TTF (regular / negrito) usados nos PDFs deste processo.
+    O registro de fato acontece na primeira chamada de get_fonts().
+    """
+    global _font_pair
+    with _font_lock:
+        _font_config["regular"] = str(regular) if regular else None
+        _font_config["bold"] = str(bold) if bold else None
+        _font_pair = None
+
+def _register_ttf(path) -> str:
+    """
+    Registra o TTF com um nome derivado do caminho resolvido (nome do
+    arquivo + hash curto), para que fontes homônimas em pastas diferentes
+    não se confundam. Caminho relativo inexistente fica como está: o
+    ReportLab o procura nas pastas de fontes dele.
+    """
+    key = os.path.realpath(path) if os.path.isfile(path) else str(path)
+    name = f"{Path(path).stem}-{hashlib.sha1(key.encode('utf-8')).hexdigest()[:8]}"
+    if name not in pdfmetrics.getRegisteredFontNames():
+        pdfmetrics.registerFont(TTFont(name, str(path)))
+    return name
+
+def _resolve_fonts(regular, bold):
+    explicit = regular is not None
+    regular = regular or DEFAULT_FONT
+    try:
+        font_r = _register_ttf(regular)
+    except Exception as e:
+        if explicit:
+            raise RuntimeError(f"Não foi possível carregar a fonte {regular}: {e}")
+        return FALLBACK_FONTS
+    if bold:
+        try:
+            return font_r, _register_ttf(bold)
+        except Exception as e:
+            raise RuntimeError(f"Não foi possível carregar a fonte {bold}: {e}")
+    # Sem negrito explícito: tenta "<nome>-Bold.ttf" ao lado da regular
+    reg = Path(regular)
+    for cand in (reg.with_name(f"{reg.stem}-Bold{reg.suffix}"), Path(DEFAULT_FONT_BOLD)):
+        try:
+            return font_r, _register_ttf(cand)
+        except Exception:
+            continue
+    return font_r, font_r
+
+def get_fonts():
+    """
+    Retorna (FONT_R, FONT_B). Os TTF são procurados e registrados só na
+    primeira chamada do processo; as seguintes usam o par em cache.
+    """
+    global _font_pair
+    pair = _font_pair
+    if pair is not None:
+        return pair
+    with _font_lock:
+        if _font_pair is None:
+            _font_pair = _resolve_fonts(_font_config["regular"], _font_config["bold"])
+        return _font_pair
+
+# =========================
+# Instrumentação (tempos por etapa)
+# =========================
+
+PROFILE_STAGES = ("parse", "layout", "qr", "save", "excel")
+
+class StageTimes:
+    """
+    Cronômetro por etapa de um arquivo: lap(etapa) soma o tempo decorrido
+    desde o último start/lap naquela etapa.
+    """
+    __slots__ = ("times", "_t")
+
+    def __init__(self):
+        self.times = {}
+        self._t = time.perf_counter()
+
+    def start(self):
+        self._t = time.perf_counter()
+
+    def lap(self, stage: str):
+        now = time.perf_counter()
+        self.times[stage] = self.times.get(stage, 0.0) + (now - self._t)
+        self._t = now
+
+class _NoStageTimes:
+    """Cronômetro nulo (padrão): sem custo quando o perfil está desligado."""
+    __slots__ = ()
+    times = None
+
+    def start(self):
+        pass
+
+    def lap(self, stage: str):
+        pass
+
+NO_TIMES = _NoStageTimes()
+
+def percentile(values, q):
+    """Percentil por posição (nearest-rank) de uma lista de números."""
+    if not values:
+        return 0.0
+    vs = sorted(values)
+    k = max(0, min(len(vs) - 1, math.ceil(q / 100 * len(vs)) - 1))
+    return vs[k]
+
+class ProfileReport:
+    """
+    Agrega os tempos por etapa do lote. Opcionalmente grava uma linha JSON
+    por arquivo e, ao fechar, uma linha de resumo (totais, percentis e os
+    N arquivos mais lentos).
+    """
+
+    def __init__(self, path: Path | None = None, slowest: int = 10):
+        self.path = Path(path) if path else None
+        self.slowest = slowest
+        self.per_stage = {stage: [] for stage in PROFILE_STAGES}
+        self.totals = []  # (segundos, nome)
+        self._fh = None
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._fh = open(self.path, "w", encoding="utf-8")
+
+    def add(self, name: str, times: dict | None, kind: str = "arquivo"):
+        if not times:
+            return
+        total = sum(times.values())
+        for stage, v in times.items():
+            self.per_stage.setdefault(stage, []).append(v)
+        self.totals.append((total, name))
+        if self._fh is not None:
+            rec = {"tipo": kind, "nome": name, "total_s": round(total, 6)}
+            rec.update({stage: round(v, 6) for stage, v in times.items()})
+            self._fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    def summary(self) -> dict:
+        stages = {}
+        for stage, vs in self.per_stage.items():
+            if vs:
+                stages[stage] = {
+                    "total_s": round(sum(vs), 6),
+                    "p50_s": round(percentile(vs, 50), 6),
+                    "p99_s": round(percentile(vs, 99), 6),
+                    "max_s": round(max(vs), 6),
+                }
+        slowest = sorted(self.totals, reverse=True)[:self.slowest]
+        return {
+            "tipo": "resumo",
+            "arquivos": len(self.totals),
+            "etapas": stages,
+            "mais_lentos": [{"nome": n, "total_s": round(t, 6)} for t, n in slowest],
+        }
+
+    def breakdown(self) -> str:
+        """Uma linha: 'parse 1.20s (10%) | layout ...'."""
+        sums = {stage: sum(vs) for stage, vs in self.per_stage.items() if vs}
+        grand = sum(sums.values()) or 1.0
+        return " | ".join(f"{stage} {v:.2f}s ({v / grand:.0%})" for stage, v in sums.items())
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.write(json.dumps(self.summary(), ensure_ascii=False) + "\n")
+            self._fh.close()
+            self._fh = None
+
 # =========================
 # Desenho do DANFE
 # =========================
 
-def draw_header(c, emit, ide, dest, chave_acesso, dhEmi_str, page_w, page_h, margin, font_b, font_r):
-    y = page_h - margin
+# -------------------------
+# Blocos repetidos como form XObject
+# -------------------------
+
+DANFE_TITLE = "DANFE NFC-e - Documento Auxiliar da Nota Fiscal de Consumidor Eletrônica"
+FORM_EXTENT = 1000  # BBox dos forms (pontos), com folga para qualquer papel
+FORM_MIN_USES = 3   # abaixo disso, desenhar direto sai menor que o form
+
+class _FormCache(dict):
+    """Blocos vistos num canvas: chave -> nº de usos diretos ou nome do form."""
+    forms = 0
+
+_canvas_forms = weakref.WeakKeyDictionary()
+
+def draw_block(c, key, y, draw):
+    """
+    Desenha um bloco que se repete entre páginas/notas (títulos, cabeçalho
+    da tabela, dados do emitente). `draw(c, y)` desenha o bloco com o topo
+    em y; `key` identifica todo o conteúdo (papel, fontes, emitente...).
+
+    Nos primeiros usos no canvas o bloco é desenhado direto (o form tem um
+    custo fixo no PDF; uma nota de uma página não ganha objetos extras). No
+    FORM_MIN_USES-ésimo ele vira um form XObject (beginForm/endForm),
+    gravado uma vez no PDF e só referenciado (doForm) daí em diante.
+    """
+    if isinstance(c, _MeasureCanvas):
+        return  # 1ª passada do layout: só as alturas importam
+    cache = _canvas_forms.get(c)
+    if cache is None:
+        cache = _canvas_forms[c] = _FormCache()
+    entry = cache.get(key, 0)
+    if isinstance(entry, int):
+        if entry + 1 < FORM_MIN_USES:
+            cache[key] = entry + 1
+            draw(c, y)
+            return
+        cache.forms += 1
+        entry = cache[key] = f"Bloco{cache.forms}"
+        c.beginForm(entry, 0, -FORM_EXTENT, FORM_EXTENT, FORM_EXTENT)
+        draw(c, 0)
+        c.endForm()
+    c.saveState()
+    c.translate(0, y)
+    c.doForm(entry)
+    c.restoreState()
+
+def _title_block(c, y, page_w, margin, font_b):
     c.setFont(font_b, 11)
-    c.drawCentredString(page_w/2, y, "DANFE NFC-e - Documento Auxiliar da Nota Fiscal de Consumidor Eletrônica")
-    y -= 6
+    c.drawCentredString(page_w/2, y, DANFE_TITLE)
     c.setLineWidth(0.5)
-    c.line(margin, y, page_w - margin, y)
-    y -= 8
+    c.line(margin, y - 6, page_w - margin, y - 6)
 
-    # Emitente
-    c.setFont(font_b, 10)
-    c.drawString(margin, y, get_text(emit, "nfe:xFant") or get_text(emit, "nfe:xNome") or "Emitente")
-    y -= 12
-
-    c.setFont(font_r, 9)
-    ender = emit.find("nfe:enderEmit", NS) if emit is not None else None
+def emitter_address(ender) -> tuple:
+    """Linhas do endereço do emitente, como saem no cabeçalho."""
     endereco = []
     if ender is not None:
-        endereco.append(f"{get_text(ender, 'nfe:xLgr')}, {get_text(ender, 'nfe:nro')}")
-        bairro = get_text(ender, "nfe:xBairro")
-        xmun = get_text(ender, "nfe:xMun")
-        uf = get_text(ender, "nfe:UF")
-        cep = get_text(ender, "nfe:CEP")
+        endereco.append(f"{ender.xLgr}, {ender.nro}")
+        bairro = ender.xBairro
+        xmun = ender.xMun
+        uf = ender.UF
+        cep = ender.CEP
         addr2 = " - ".join(filter(None, [bairro, f"{xmun}/{uf}"]))
         if addr2:
             endereco.append(addr2)
         if cep:
             endereco.append(f"CEP {cep}")
+    return tuple(endereco)
+
+def _emitter_block(c, y, emit, endereco, margin, font_b, font_r):
+    c.setFont(font_b, 10)
+    c.drawString(margin, y, emit.xFant or emit.xNome or "Emitente")
+    y -= 12
+    c.setFont(font_r, 9)
     for ln in endereco:
         c.drawString(margin, y, ln)
         y -= 11
-    c.drawString(margin, y, f"CNPJ: {get_text(emit,'nfe:CNPJ')}   IE: {get_text(emit,'nfe:IE')}")
+    c.drawString(margin, y, f"CNPJ: {emit.CNPJ}   IE: {emit.IE}")
+
+def _continuation_block(c, y, page_w, font_b):
+    c.setFont(font_b, 11)
+    c.drawCentredString(page_w/2, y, "DANFE NFC-e (continuação)")
+
+def draw_header(c, doc, page_w, page_h, margin, font_b, font_r):
+    y = page_h - margin
+    draw_block(c, ("titulo", page_w, margin, font_b), y,
+               lambda c, y: _title_block(c, y, page_w, margin, font_b))
     y -= 14
 
+    # Emitente (um form por CNPJ/endereço: o lote de uma loja repete o mesmo bloco)
+    emit = doc.emit
+    endereco = emitter_address(emit.ender)
+    draw_block(c, ("emitente", margin, font_b, font_r, emit), y,
+               lambda c, y: _emitter_block(c, y, emit, endereco, margin, font_b, font_r))
+    y -= 12 + 11*len(endereco) + 14
+
     # Chave e emissão
     c.setFont(font_b, 9)
     c.drawString(margin, y, "CHAVE DE ACESSO:")
     c.setFont(font_r, 9)
-    c.drawString(margin+90, y, format_chave(chave_acesso))
+    c.drawString(margin+90, y, format_chave(doc.chave))
     y -= 12
 
-    if dhEmi_str:
+    if doc.dhEmi_str:
         c.setFont(font_b, 9); c.drawString(margin, y, "Emissão:")
-        c.setFont(font_r, 9); c.drawString(margin+50, y, dhEmi_str)
+        c.setFont(font_r, 9); c.drawString(margin+50, y, doc.dhEmi_str)
     y -= 12
 
     # Destinatário
     c.setFont(font_b, 9); c.drawString(margin, y, "Consumidor:")
     c.setFont(font_r, 9)
-    dest_nome = get_text(dest, "nfe:xNome") or "Não informado"
-    dest_doc = get_text(dest, "nfe:CPF") or get_text(dest, "nfe:CNPJ")
+    dest_nome = doc.dest.xNome or "Não informado"
+    dest_doc = doc.dest.doc
     doc_str = f" ({dest_doc})" if dest_doc else ""
     c.drawString(margin+65, y, dest_nome + doc_str)
     y -= 6
+    c.setLineWidth(0.5)
     c.line(margin, y, page_w - margin, y)
     return y - 6
 
-def draw_items_header(c, x, y, widths, font_b):
+ITEM_HEADERS = ("CÓD", "DESCRIÇÃO", "QTD", "UN", "V.UNIT", "V.TOTAL")
+ITEM_TEXT_FONT = "Helvetica"
+
+@dataclass(frozen=True, slots=True)
+class ItemLayout:
+    """Colunas da tabela de itens, calculadas uma vez por papel (ver item_layout)."""
+    x: float
+    widths: tuple
+    col_x: tuple     # início de cada coluna
+    total_w: float
+    desc_w: float    # largura útil da descrição
+    qtd_rx: float    # âncoras dos textos alinhados à direita
+    vunit_rx: float
+    vtot_rx: float
+
+@lru_cache(maxsize=None)
+def item_layout(paper="A4") -> ItemLayout:
+    page_w, _, margin = page_geometry(paper)
+    widths = (22*mm, 64*mm if page_w < 100*mm else 90*mm, 10*mm, 14*mm, 25*mm, 28*mm)
+    col_x = []
+    x0 = margin
+    for w in widths:
+        col_x.append(x0)
+        x0 += w
+    return ItemLayout(
+        x=margin, widths=widths, col_x=tuple(col_x), total_w=sum(widths), desc_w=widths[1] - 4,
+        qtd_rx=col_x[2] + 25, vunit_rx=col_x[4] + 20, vtot_rx=col_x[5] + 25,
+    )
+
+def _items_header_block(c, y, layout: ItemLayout, font_b):
     c.setFont(font_b, 9)
-    headers = ["CÓD", "DESCRIÇÃO", "QTD", "UN", "V.UNIT", "V.TOTAL"]
-    x0 = x
-    for i, h in enumerate(headers):
+    for x0, h in zip(layout.col_x, ITEM_HEADERS):
         c.drawString(x0+2, y-2, h)
-        x0 += widths[i]
-    y -= 10
     c.setLineWidth(0.3)
-    c.line(x, y, x + sum(widths), y)
-    return y - 15
+    c.line(layout.x, y - 10, layout.x + layout.total_w, y - 10)
+
+def draw_items_header(c, layout: ItemLayout, y, font_b):
+    draw_block(c, ("itens", layout, font_b), y, lambda c, y: _items_header_block(c, y, layout, font_b))
+    return y - 25
 
-def draw_item_row(c, x, y, widths, font_r, prod):
+def draw_item_row(c, layout: ItemLayout, y, font_r, item):
     c.setFont(font_r, 9)
-    x0 = x
-    col_texts = [
-        get_text(prod, "nfe:cProd"),
-        get_text(prod, "nfe:xProd"),
-        f"{Decimal(get_text(prod,'nfe:qCom') or '0'):,.4f}".replace(",", "X").replace(".", ",").replace("X","."),
-        get_text(prod, "nfe:uCom"),
-        br_currency(get_text(prod,"nfe:vUnCom")),
-        br_currency(get_text(prod,"nfe:vProd")),
-    ]
-    c.drawString(x0+2, y, col_texts[0][:12]); x0 += widths[0]
-    y, used = wrap_text(c, col_texts[1], x0+2, y, widths[1]-4, line_height=10, max_lines=2)
-    x0 += widths[1]
-    c.drawRightString(x0+25, y + (10*used), col_texts[2]); x0 += widths[2]
-    c.drawString(x0+2, y + (10*used), col_texts[3]); x0 += widths[3]
-    c.drawRightString(x0+20, y + (10*used), col_texts[4]); x0 += widths[4]
-    c.drawRightString(x0+25, y + (10*used), col_texts[5])
+    col_x = layout.col_x
+    c.drawString(col_x[0]+2, y, item.cProd[:12])
+    # descrição e valores saem na fonte base (como sempre saíram)
+    c.setFont(ITEM_TEXT_FONT, 9)
+    lines = wrap_lines(item.xProd, layout.desc_w, ITEM_TEXT_FONT, 9)[:2]
+    y, used = draw_lines(c, lines, col_x[1]+2, y, line_height=10)
+    y_num = y + (10*used)
+    c.drawRightString(layout.qtd_rx, y_num, br_qty_text(item.qCom))
+    c.drawString(col_x[3]+2, y_num, item.uCom)
+    c.drawRightString(layout.vunit_rx, y_num, br_money_text(item.vUnCom))
+    c.drawRightString(layout.vtot_rx, y_num, br_money_text(item.vProd))
     return y - 4
 
-def draw_totals(c, icmstot, y, page_w, margin, font_b, font_r):
+def draw_totals(c, totais, y, page_w, margin, font_b, font_r):
     c.setLineWidth(0.3)
     c.line(margin, y, page_w - margin, y)
     y -= 12
-    vDesc = get_dec(icmstot, "nfe:vDesc")
-    vOutro = get_dec(icmstot, "nfe:vOutro")
-    vProd  = get_dec(icmstot, "nfe:vProd")
-    vNF    = get_dec(icmstot, "nfe:vNF")
+    vDesc = totais.vDesc
+    vOutro = totais.vOutro
+    vProd  = totais.vProd
+    vNF    = totais.vNF
     c.setFont(font_b, 10); c.drawString(margin, y, "Totais")
     y -= 12
     c.setFont(font_r, 9)
@@ -233,18 +956,17 @@ def draw_payments(c, pag, y, page_w, margin, font_b, font_r):
     c.setFont(font_b, 10); c.drawString(margin, y, "Pagamentos")
     y -= 12
     c.setFont(font_r, 9)
-    dets = pag.findall("nfe:detPag", NS)
-    for dp in dets:
-        tPag = get_text(dp, "nfe:tPag")
-        xPag = get_text(dp, "nfe:xPag")
-        vPag = get_dec(dp, "nfe:vPag")
+    for dp in pag.detalhes:
+        tPag = dp.tPag
+        xPag = dp.xPag
+        vPag = dp.vPag
         meio = TPAG_MAP.get(tPag, f"Código {tPag}")
         if xPag:
             meio = f"{meio} ({xPag})"
         c.drawString(margin, y, f"{meio}")
         c.drawRightString(page_w - margin, y, br_currency(vPag))
         y -= 12
-    vTroco = get_dec(pag, "nfe:vTroco")
+    vTroco = pag.vTroco
     if vTroco > 0:
         c.setFont(font_b, 9)
         c.drawString(margin, y, "Troco")
@@ -252,22 +974,61 @@ def draw_payments(c, pag, y, page_w, margin, font_b, font_r):
         y -= 12
     return y
 
-def draw_qrcode_and_footer(c, infNFeSupl, chave, y, page_w, margin, font_r):
-    url_qr = get_text(infNFeSupl, "nfe:qrCode") if infNFeSupl is not None else ""
+QR_CACHE_SIZE = 1024
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def qr_runs(url_qr: str):
+    """
+    Codifica o QR e devolve (n, runs): n = módulos por lado (com a borda de
+    4 módulos) e runs = trechos horizontais escuros (linha, coluna, largura).
+    Fica em cache por URL: reimpressões e XMLs duplicados não recodificam.
+    """
+    qr = qrcode.QRCode(border=4)
+    qr.add_data(url_qr)
+    qr.make(fit=True)
+    matrix = qr.get_matrix()
+    runs = []
+    for r, row in enumerate(matrix):
+        start = None
+        for col, dark in enumerate(row):
+            if dark and start is None:
+                start = col
+            elif not dark and start is not None:
+                runs.append((r, start, col - start))
+                start = None
+        if start is not None:
+            runs.append((r, start, len(row) - start))
+    return len(matrix), tuple(runs)
+
+def draw_qr_vector(c, url_qr, x, y_top, size):
+    """Desenha o QR como retângulos vetoriais (sem gerar/decodificar PNG)."""
+    n, runs = qr_runs(url_qr)
+    m = size / n
+    p = c.beginPath()
+    for r, col, w in runs:
+        p.rect(x + col*m, y_top - (r + 1)*m, w*m, m)
+    c.saveState()
+    c.setFillColorRGB(0, 0, 0)
+    c.drawPath(p, stroke=0, fill=1)
+    c.restoreState()
+
+def _qr_caption_block(c, y, x):
+    c.setFont("Helvetica", 8)
+    c.drawString(x, y - 10, "Consulta via leitor de QR Code")
+    c.drawString(x, y - 22, "Ou acesse o portal da SEFAZ e informe a chave:")
+
+def _footer_note_block(c, y, page_w):
+    c.setFont("Helvetica", 7)
+    c.drawCentredString(page_w/2, y, "DANFE NFC-e - Não é documento fiscal. Válido como representação simplificada da NFC-e.")
+
+def draw_qrcode_and_footer(c, url_qr, chave, y, page_w, margin, font_r):
     c.setLineWidth(0.3)
     c.line(margin, y, page_w - margin, y)
     y -= 8
     if url_qr:
-        qr_img = qrcode.make(url_qr)
-        qr_buf = io.BytesIO()
-        qr_img.save(qr_buf, format="PNG")
-        qr_buf.seek(0)
-        qr_reader = ImageReader(qr_buf)
         size = 34*mm
-        c.drawImage(qr_reader, margin, y - size, width=size, height=size, preserveAspectRatio=True, mask='auto')
-        c.setFont("Helvetica", 8)
-        c.drawString(margin + size + 6, y - 10, "Consulta via leitor de QR Code")
-        c.drawString(margin + size + 6, y - 22, "Ou acesse o portal da SEFAZ e informe a chave:")
+        draw_qr_vector(c, url_qr, margin, y, size)
+        draw_block(c, ("consulta", margin + size + 6), y, lambda c, y: _qr_caption_block(c, y, margin + size + 6))
         c.setFont("Helvetica-Bold", 8)
         c.drawString(margin + size + 6, y - 34, format_chave(chave))
         y -= size + 6
@@ -276,8 +1037,7 @@ def draw_qrcode_and_footer(c, infNFeSupl, chave, y, page_w, margin, font_r):
         c.drawString(margin, y, "QR Code não informado no XML.")
         y -= 14
 
-    c.setFont("Helvetica", 7)
-    c.drawCentredString(page_w/2, y, "DANFE NFC-e - Não é documento fiscal. Válido como representação simplificada da NFC-e.")
+    draw_block(c, ("rodape", page_w), y, lambda c, y: _footer_note_block(c, y, page_w))
     y -= 10
     return y
 
@@ -285,182 +1045,780 @@ def draw_qrcode_and_footer(c, infNFeSupl, chave, y, page_w, margin, font_r):
 # Core: PDF e Lote + Excel
 # =========================
 
-def robust_extract_chave(root) -> str:
+def as_nfce(source) -> NFCe:
     """
-    Tenta extrair a chave de acesso da NFC-e a partir de:
-    - infNFe/@Id
-    - nfeProc/protNFe/infProt/chNFe
-    Retorna apenas dígitos (até 44).
+    Aceita um NFCe já montado, o XML em bytes, uma árvore/elemento lxml já
+    parseado ou um caminho de XML (parseado uma vez).
     """
-    chave = ""
-    nfe = root.find("nfe:NFe", NS)
-    if nfe is None and root.tag.endswith("NFe"):
-        nfe = root
-    if nfe is not None:
-        inf = nfe.find("nfe:infNFe", NS)
-        if inf is not None:
-            chave = (inf.get("Id") or "").replace("NFe", "")
-    if not chave:
-        ch = root.find(".//nfe:protNFe/nfe:infProt/nfe:chNFe", NS)
-        if ch is not None and ch.text:
-            chave = ch.text.strip()
-    chave = "".join([c for c in chave if c.isdigit()])[:44]
-    return chave
+    if isinstance(source, NFCe):
+        return source
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return nfce_from_root(parse_xml(source))
+    if isinstance(source, ET._ElementTree):
+        return nfce_from_root(source.getroot())
+    if isinstance(source, ET._Element):
+        return nfce_from_root(source)
+    return load_nfce(source)
+
+EXCEL_COLUMNS = ["DATA EMISSÃO","CHAVE ELETRÔNICA","CÓD","DESCRIÇÃO","QTD","UN","V.UNIT","V.TOTAL"]
+
+class ItemRow(NamedTuple):
+    """Item já pronto para exportação (tupla: sem dicionário por linha)."""
+    cProd: str
+    xProd: str
+    qCom: float
+    uCom: str
+    vUnCom: float
+    vProd: float
+
+@dataclass(frozen=True, slots=True)
+class ReceiptRows:
+    """
+    Linhas de exportação de uma NFC-e: data de emissão e chave ficam uma
+    vez por nota; os itens (ItemRow) só as referenciam.
+    """
+    dhEmi_str: str
+    chave: str
+    itens: tuple
+
+    def __len__(self):
+        return len(self.itens)
+
+    def values(self):
+        """Valores de cada linha na ordem de EXCEL_COLUMNS."""
+        head = (self.dhEmi_str, self.chave)
+        for it in self.itens:
+            yield head + it
+
+    def as_dicts(self):
+        return [dict(zip(EXCEL_COLUMNS, v)) for v in self.values()]
+
+def _to_float(v: str) -> float:
+    if not v:
+        return 0.0
+    try:
+        return float(v)
+    except ValueError:
+        return 0.0
 
-def parse_items_for_excel(xml_path: Path):
+def excel_rows(doc: NFCe) -> ReceiptRows:
     """
-    Lê um XML e retorna uma lista de dicionários (linhas) com as colunas do Excel.
+    Monta as linhas de exportação (ReceiptRows) a partir do modelo NFCe.
     """
-    rows = []
-    tree = ET.parse(str(xml_path))
-    root = tree.getroot()
+    return ReceiptRows(
+        dhEmi_str=doc.dhEmi_str,
+        chave=doc.chave,
+        itens=tuple(
+            ItemRow(it.cProd, it.xProd, _to_float(it.qCom), it.uCom, _to_float(it.vUnCom), _to_float(it.vProd))
+            for it in doc.itens
+        ),
+    )
 
-    nfe = root.find("nfe:NFe", NS)
-    if nfe is None and root.tag.endswith("NFe"):
-        nfe = root
-    inf = nfe.find("nfe:infNFe", NS) if nfe is not None else None
-    ide  = inf.find("nfe:ide", NS) if inf is not None else None
+def parse_items_for_excel(xml_path):
+    """
+    Lê um XML (ou usa o NFCe já montado) e retorna uma lista de dicionários
+    (linhas) com as colunas do Excel.
+    """
+    return excel_rows(as_nfce(xml_path)).as_dicts()
 
-    dhEmi = get_text(ide, "nfe:dhEmi")
-    dhEmi_str = ""
-    if dhEmi:
-        try:
-            dt = datetime.fromisoformat(dhEmi)  # 2025-07-15T15:33:21-03:00
-            dhEmi_str = dt.strftime("%d/%m/%Y %H:%M:%S")
-        except Exception:
-            dhEmi_str = dhEmi
+def row_values(rows):
+    """
+    Normaliza para sequências na ordem de EXCEL_COLUMNS: aceita ReceiptRows
+    ou uma lista de dicionários (formato de parse_items_for_excel).
+    """
+    if isinstance(rows, ReceiptRows):
+        return rows.values()
+    return ([row[col] for col in EXCEL_COLUMNS] for row in rows)
 
-    chave = robust_extract_chave(root)
+# -------------------------
+# Exportação de itens em streaming (xlsx / csv / parquet)
+# -------------------------
 
-    dets = inf.findall("nfe:det", NS) if inf is not None else []
-    for det in dets:
-        prod = det.find("nfe:prod", NS)
-        if prod is None:
-            continue
-        qCom = get_text(prod, "nfe:qCom") or "0"
-        vUnCom = get_text(prod, "nfe:vUnCom") or "0"
-        vProd = get_text(prod, "nfe:vProd") or "0"
-        try:
-            qCom_f = float(Decimal(qCom))
-        except Exception:
-            qCom_f = 0.0
-        try:
-            vUnCom_f = float(Decimal(vUnCom))
-        except Exception:
-            vUnCom_f = 0.0
+EXCEL_MAX_ROWS = 1_048_576  # limite de linhas por planilha do Excel (inclui o cabeçalho)
+PARQUET_BATCH_ROWS = 65_536
+
+class ExcelItemsWriter:
+    """
+    Grava as linhas em .xlsx à medida que chegam (openpyxl write-only, sem
+    manter as linhas em memória). Ao atingir o limite do Excel, abre uma
+    nova planilha (Itens, Itens_2, ...). Com append=True, as linhas de um
+    arquivo existente são copiadas antes das novas.
+    """
+    label = "EXCEL"
+
+    def __init__(self, path: Path, append: bool = False):
+        self.path = Path(path)
+        self.append = append
+        self.count = 0
+        self._wb = None
+        self._ws = None
+        self._sheet_rows = 0
+
+    def _new_sheet(self):
+        n = len(self._wb.worksheets) + 1
+        self._ws = self._wb.create_sheet("Itens" if n == 1 else f"Itens_{n}")
+        self._ws.append(EXCEL_COLUMNS)
+        self._sheet_rows = 1
+
+    def write_rows(self, rows):
+        if self._wb is None:
+            if not OPENPYXL_AVAILABLE:
+                raise RuntimeError("Exportação para Excel requer openpyxl. Instale com: pip install openpyxl")
+            self._wb = Workbook(write_only=True)
+            self._new_sheet()
+            if self.append and self.path.exists():
+                self._copy_existing()
+        self._append_values(row_values(rows))
+
+    def _append_values(self, values_iter):
+        for values in values_iter:
+            if self._sheet_rows >= EXCEL_MAX_ROWS:
+                self._new_sheet()
+            self._ws.append(values)
+            self._sheet_rows += 1
+            self.count += 1
+
+    def _copy_existing(self):
+        # O .xlsx não aceita append: relê as linhas (modo read-only) e regrava
+        old = load_workbook(str(self.path), read_only=True)
         try:
-            vProd_f = float(Decimal(vProd))
-        except Exception:
-            vProd_f = 0.0
-
-        rows.append({
-            "DATA EMISSÃO": dhEmi_str,
-            "CHAVE ELETRÔNICA": chave,
-            "CÓD": get_text(prod, "nfe:cProd"),
-            "DESCRIÇÃO": get_text(prod, "nfe:xProd"),
-            "QTD": qCom_f,
-            "UN": get_text(prod, "nfe:uCom"),
-            "V.UNIT": vUnCom_f,
-            "V.TOTAL": vProd_f,
-        })
-    return rows
+            for ws in old.worksheets:
+                self._append_values(islice(ws.iter_rows(values_only=True), 1, None))
+        finally:
+            old.close()
+
+    def flush(self):
+        pass  # o .xlsx só é gravado no close
+
+    def close(self):
+        if self._wb is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # grava ao lado e troca: uma falha no meio não destrói o arquivo anterior
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            self._wb.save(str(tmp))
+            os.replace(tmp, self.path)
+            self._wb = None
+
+class CsvItemsWriter:
+    """Grava as linhas em CSV (UTF-8) à medida que chegam (append=True: acrescenta ao arquivo)."""
+    label = "CSV"
+
+    def __init__(self, path: Path, append: bool = False):
+        self.path = Path(path)
+        self.append = append
+        self.count = 0
+        self._fh = None
+        self._w = None
+
+    def write_rows(self, rows):
+        if self._fh is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            new = not (self.append and self.path.exists() and self.path.stat().st_size > 0)
+            self._fh = open(self.path, "a" if self.append else "w", encoding="utf-8", newline="")
+            self._w = csv.writer(self._fh)
+            if new:
+                self._w.writerow(EXCEL_COLUMNS)
+        for values in row_values(rows):
+            self._w.writerow(values)
+            self.count += 1
+
+    def flush(self):
+        if self._fh is not None:
+            self._fh.flush()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+class ParquetItemsWriter:
+    """
+    Grava as linhas em Parquet (pyarrow) em lotes de PARQUET_BATCH_ROWS.
+    Com append=True, os lotes de um arquivo existente são copiados antes das
+    novas linhas (num .tmp, trocado pelo original no close).
+    """
+    label = "PARQUET"
+
+    def __init__(self, path: Path, append: bool = False):
+        self.path = Path(path)
+        self.append = append
+        self.count = 0
+        self._pw = None
+        self._buf = []
+        self._target = self.path
+
+    def _flush(self):
+        if not self._buf:
+            return
+        cols = list(zip(*self._buf))
+        table = pa.Table.from_arrays([pa.array(col) for col in cols], schema=self._schema)
+        self._pw.write_table(table)
+        self._buf = []
+
+    def write_rows(self, rows):
+        if self._pw is None:
+            if not PYARROW_AVAILABLE:
+                raise RuntimeError("Exportação para Parquet requer pyarrow. Instale com: pip install pyarrow")
+            self._schema = pa.schema([
+                (col, pa.float64() if col in ("QTD", "V.UNIT", "V.TOTAL") else pa.string())
+                for col in EXCEL_COLUMNS
+            ])
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            if self.append and self.path.exists():
+                self._target = self.path.with_name(self.path.name + ".tmp")
+                self._pw = pq.ParquetWriter(str(self._target), self._schema)
+                old = pq.ParquetFile(str(self.path))
+                for batch in old.iter_batches(batch_size=PARQUET_BATCH_ROWS):
+                    self._pw.write_table(pa.Table.from_batches([batch]).cast(self._schema))
+                    self.count += batch.num_rows
+            else:
+                self._pw = pq.ParquetWriter(str(self.path), self._schema)
+        for values in row_values(rows):
+            self._buf.append(values)
+            self.count += 1
+            if len(self._buf) >= PARQUET_BATCH_ROWS:
+                self._flush()
+
+    def flush(self):
+        pass  # grupos de linhas pequenos degradam o Parquet; grava por lote
+
+    def close(self):
+        if self._pw is not None:
+            self._flush()
+            self._pw.close()
+            self._pw = None
+            if self._target != self.path:
+                os.replace(self._target, self.path)
+
+def open_items_writer(path: Path, append: bool = False):
+    """Escolhe o writer pela extensão: .csv, .parquet ou (padrão) .xlsx."""
+    suffix = Path(path).suffix.lower()
+    if suffix == ".csv":
+        return CsvItemsWriter(path, append)
+    if suffix == ".parquet":
+        return ParquetItemsWriter(path, append)
+    return ExcelItemsWriter(path, append)
+
+class ItemsExport:
+    """
+    Distribui as linhas de cada XML para um ou mais writers. Um erro num
+    writer é registrado e desativa só aquele writer; os PDFs seguem.
+    """
+
+    def __init__(self, paths, log_fn=None, append: bool = False):
+        self.writers = [open_items_writer(p, append) for p in paths if p is not None]
+        self.log_fn = log_fn
+
+    def __bool__(self):
+        return bool(self.writers)
+
+    def write(self, rows):
+        if not rows:
+            return
+        for w in list(self.writers):
+            try:
+                w.write_rows(rows)
+            except Exception as ee:
+                self.writers.remove(w)
+                if self.log_fn: self.log_fn(f"[ERRO {w.label}] {ee}")
+
+    def flush(self):
+        for w in self.writers:
+            w.flush()
+
+    def close(self):
+        for w in self.writers:
+            try:
+                w.close()
+            except Exception as ee:
+                if self.log_fn: self.log_fn(f"[ERRO {w.label}] {ee}")
+                continue
+            if self.log_fn:
+                if w.count:
+                    self.log_fn(f"[{w.label}] {w.count} linha(s) exportadas para: {w.path}")
+                else:
+                    self.log_fn("Nenhum item para exportar ao Excel.")
 
 def export_excel(rows, excel_path: Path, log_fn=None):
+    """Exporta uma lista de linhas (o formato segue a extensão de excel_path)."""
     if not rows:
         if log_fn: log_fn("Nenhum item para exportar ao Excel.")
         return
-    if not PANDAS_AVAILABLE:
-        raise RuntimeError("Exportação para Excel requer pandas. Instale com: pip install pandas openpyxl")
-    df = pd.DataFrame(rows, columns=[
-        "DATA EMISSÃO","CHAVE ELETRÔNICA","CÓD","DESCRIÇÃO","QTD","UN","V.UNIT","V.TOTAL"
-    ])
-    excel_path.parent.mkdir(parents=True, exist_ok=True)
-    df.to_excel(str(excel_path), index=False)
-    if log_fn: log_fn(f"[EXCEL] {len(df)} linha(s) exportadas para: {excel_path}")
-
-def make_pdf(xml_path, out_pdf, paper="A4"):
-    # Fonte TTF (opcional)
-    try:
-        pdfmetrics.registerFont(TTFont("DejaVu", "DejaVuSans.ttf"))
-        FONT_R = "DejaVu"
-        FONT_B = "DejaVu"
-    except Exception:
-        FONT_R = "Helvetica"
-        FONT_B = "Helvetica-Bold"
+    w = open_items_writer(excel_path)
+    w.write_rows(rows)
+    w.close()
+    if log_fn: log_fn(f"[{w.label}] {w.count} linha(s) exportadas para: {w.path}")
 
-    tree = ET.parse(xml_path)
-    root = tree.getroot()
+def is_roll_paper(paper) -> bool:
+    """Bobina térmica (80mm): página contínua, do tamanho do conteúdo."""
+    return str(paper).lower().startswith("80")
 
-    nfe = root.find("nfe:NFe", NS)
-    if nfe is None and root.tag.endswith("NFe"):
-        nfe = root
-    inf = nfe.find("nfe:infNFe", NS) if nfe is not None else None
-
-    ide  = inf.find("nfe:ide", NS) if inf is not None else None
-    emit = inf.find("nfe:emit", NS) if inf is not None else None
-    dest = inf.find("nfe:dest", NS) if inf is not None else None
-    total= inf.find("nfe:total/nfe:ICMSTot", NS) if inf is not None else None
-    pag  = inf.find("nfe:pag", NS) if inf is not None else None
-    infSupl = nfe.find("nfe:infNFeSupl", NS) if nfe is not None else None
-
-    chave = robust_extract_chave(root)
-    dhEmi = get_text(ide, "nfe:dhEmi")
-    dhEmi_str = ""
-    if dhEmi:
-        try:
-            dt = datetime.fromisoformat(dhEmi)  # 2025-07-15T15:33:21-03:00
-            dhEmi_str = dt.strftime("%d/%m/%Y %H:%M:%S")
-        except Exception:
-            dhEmi_str = dhEmi
-
-    # Página
-    if str(paper).lower().startswith("80"):
-        page_w, page_h = (80*mm, 280*mm)
-        margin = 5*mm
-    else:
-        page_w, page_h = A4
-        margin = 12*mm
+def page_geometry(paper="A4"):
+    """
+    Retorna (page_w, page_h, margin) para o papel escolhido. Na bobina,
+    page_h é só a altura inicial do canvas: draw_danfe ajusta cada página
+    à altura do cupom.
+    """
+    if is_roll_paper(paper):
+        return 80*mm, 280*mm, 5*mm
+    page_w, page_h = A4
+    return page_w, page_h, 12*mm
 
-    c = canvas.Canvas(str(out_pdf), pagesize=(page_w, page_h))
+# Altura máxima de uma página contínua: 200 polegadas é o limite prático dos
+# leitores de PDF; cupons maiores que isso são paginados nessa altura.
+ROLL_MAX_PAGE_H = 14400
 
-    y = draw_header(c, emit, ide, dest, chave, dhEmi_str, page_w, page_h, margin, FONT_B, FONT_R)
+class _MeasureCanvas:
+    """
+    Canvas da 1ª passada: aceita qualquer chamada de desenho e não faz nada.
+    Rodando as próprias funções draw_* nele, o y devolvido dá a altura de
+    cada bloco, com a mesma conta do desenho.
+    """
 
-    # Tabela itens
-    col_widths = [22*mm, 64*mm if page_w < 100*mm else 90*mm, 10*mm, 14*mm, 25*mm, 28*mm]
-    x = margin
-    y = draw_items_header(c, x, y, col_widths, FONT_B)
+    def __getattr__(self, name):
+        return self._noop
+
+    def _noop(self, *args, **kwargs):
+        return self
+
+_MEASURE = _MeasureCanvas()
+
+@dataclass(frozen=True, slots=True)
+class DanfeBlocks:
+    """Alturas medidas (em pontos) dos blocos de um DANFE."""
+    header: float
+    items_header: float
+    rows: tuple
+    tail: float  # separação + totais + pagamentos + QR/rodapé
+
+    @property
+    def total(self) -> float:
+        return self.header + self.items_header + sum(self.rows) + self.tail
+
+def measure_danfe(doc: NFCe, paper="A4", fonts=None) -> DanfeBlocks:
+    """1ª passada do layout: mede cada bloco sem desenhar nada."""
+    font_r, font_b = fonts or get_fonts()
+    page_w, page_h, margin = page_geometry(paper)
+    layout = item_layout(paper)
+    m = _MEASURE
+    header = (page_h - margin) - draw_header(m, doc, page_w, page_h, margin, font_b, font_r)
+    items_header = -draw_items_header(m, layout, 0.0, font_b)
+    rows = tuple(-draw_item_row(m, layout, 0.0, font_r, item) for item in doc.itens)
+    y = draw_totals(m, doc.totais, -6.0, page_w, margin, font_b, font_r)
+    y = draw_payments(m, doc.pag, y, page_w, margin, font_b, font_r)
+    y = draw_qrcode_and_footer(m, doc.qr_url, doc.chave, y, page_w, margin, font_r)
+    return DanfeBlocks(header, items_header, rows, -y)
+
+def draw_danfe(c, doc: NFCe, paper="A4", timer=NO_TIMES, fonts=None):
+    """
+    Desenha um DANFE completo no canvas `c`, a partir da página atual, e
+    fecha a última página. Usado tanto no PDF por nota quanto no consolidado.
+    `timer` (StageTimes, já iniciado) recebe os tempos de "layout", "qr" e
+    "save" (serialização da página). `fonts` = (regular, negrito) já
+    registradas; se omitido, usa o par em cache de get_fonts().
+
+    Layout em duas passadas: measure_danfe mede os blocos; aqui eles são
+    posicionados. Na bobina (80mm) o cupom sai numa única página com a
+    altura do conteúdo; no A4, uma linha de item só quebra a página quando
+    não cabe mais, e totais/pagamentos/QR vão juntos para a página seguinte
+    se não couberem abaixo dos itens.
+    """
+    # Fonte TTF (opcional; registrada uma vez por processo)
+    FONT_R, FONT_B = fonts or get_fonts()
+    fonts = (FONT_R, FONT_B)
 
-    dets = inf.findall("nfe:det", NS) if inf is not None else []
-    for det in dets:
-        prod = det.find("nfe:prod", NS)
-        row_height = 24  # estimativa
-        if y - row_height < 40*mm:
-            c.showPage()
-            y = page_h - margin
-            c.setFont(FONT_B, 11)
-            c.drawCentredString(page_w/2, y, "DANFE NFC-e (continuação)")
-            y -= 14
-            y = draw_items_header(c, x, y, col_widths, FONT_B)
-        y = draw_item_row(c, x, y, col_widths, FONT_R, prod)
+    # Página
+    page_w, page_h, margin = page_geometry(paper)
+    blocks = measure_danfe(doc, paper, fonts)
+    roll = is_roll_paper(paper)
+    bottom = margin - 0.5  # folga para o arredondamento das alturas medidas
+    if roll:
+        page_h = blocks.total + 2*margin
+        if page_h <= ROLL_MAX_PAGE_H:
+            bottom = -math.inf  # página única: tudo cabe por construção
+        else:
+            page_h = ROLL_MAX_PAGE_H
+        c.setPageSize((page_w, page_h))
+    rest = sum(blocks.rows) + blocks.tail  # altura do que falta desenhar
+
+    def new_page(rest_h):
+        nonlocal page_h
+        c.showPage()
+        if roll:
+            # bobina longa: cada página nova só tem a altura que ainda falta
+            page_h = min(14 + rest_h + 2*margin, ROLL_MAX_PAGE_H)
+            c.setPageSize((page_w, page_h))
+        y = page_h - margin
+        draw_block(c, ("continuacao", page_w, FONT_B), y,
+                   lambda c, y: _continuation_block(c, y, page_w, FONT_B))
+        return y - 14
+
+    y = draw_header(c, doc, page_w, page_h, margin, FONT_B, FONT_R)
+
+    # Tabela itens (colunas pré-calculadas por papel)
+    layout = item_layout(paper)
+    y = draw_items_header(c, layout, y, FONT_B)
+
+    for item, row_h in zip(doc.itens, blocks.rows):
+        if y - row_h < bottom:
+            y = draw_items_header(c, layout, new_page(blocks.items_header + rest), FONT_B)
+        y = draw_item_row(c, layout, y, FONT_R, item)
+        rest -= row_h
+
+    # Totais, pagamentos e QR ficam juntos
+    if y - blocks.tail < bottom:
+        y = new_page(blocks.tail)
 
     # Totais
-    y = max(y - 6, 60*mm)
-    y = draw_totals(c, total, y, page_w, margin, FONT_B, FONT_R)
+    y -= 6
+    y = draw_totals(c, doc.totais, y, page_w, margin, FONT_B, FONT_R)
 
     # Pagamentos e troco
-    y = draw_payments(c, pag, y, page_w, margin, FONT_B, FONT_R)
+    y = draw_payments(c, doc.pag, y, page_w, margin, FONT_B, FONT_R)
+    timer.lap("layout")
 
     # QRCode + rodapé
-    y = draw_qrcode_and_footer(c, infSupl, chave, y, page_w, margin, FONT_R)
+    y = draw_qrcode_and_footer(c, doc.qr_url, doc.chave, y, page_w, margin, FONT_R)
+    timer.lap("qr")
 
     c.showPage()
-    c.save()
+    timer.lap("save")
+
+# O subset das fontes TTF (feito no c.save()) usa um leitor compartilhado
+# dentro do ReportLab: duas threads salvando ao mesmo tempo corrompem o PDF.
+_pdf_save_lock = threading.Lock()
+
+def render_pdf(source, out=None, paper="A4", timer=NO_TIMES, fonts=None):
+    """
+    Renderiza o DANFE em memória, sem arquivo temporário.
+
+    `source`: XML em bytes, árvore/elemento lxml, NFCe ou caminho do XML.
+    `out`: None -> retorna os bytes do PDF; stream binário (qualquer objeto
+    com write) -> grava nele e retorna None; caminho -> grava o arquivo.
+
+    Não altera estado global (cada chamada tem o seu canvas; fontes e QR vêm
+    dos caches, protegidos), então pode ser chamada de várias threads; só a
+    gravação final (subset das fontes) é serializada.
+    """
+    timer.start()
+    doc = as_nfce(source)
+    timer.lap("parse")
+    fonts = fonts or get_fonts()
+    buf = io.BytesIO() if out is None else None
+    if buf is not None:
+        target = buf
+    elif hasattr(out, "write"):
+        target = out
+    else:
+        target = str(out)
+    page_w, page_h, _ = page_geometry(paper)
+    c = canvas.Canvas(target, pagesize=(page_w, page_h))
+    draw_danfe(c, doc, paper, timer, fonts)
+    with _pdf_save_lock:
+        c.save()
+    timer.lap("save")
+    return buf.getvalue() if buf is not None else None
+
+def make_pdf(xml_path, out_pdf, paper="A4", timer=NO_TIMES):
+    """
+    Gera o PDF do DANFE. `xml_path` pode ser o caminho do XML ou um NFCe já
+    montado por load_nfce (evita parsear o mesmo arquivo de novo).
+    """
+    render_pdf(xml_path, out_pdf, paper=paper, timer=timer)
+
+# -------------------------
+# PDF consolidado (várias NFC-e num único arquivo)
+# -------------------------
+
+COMBINE_MODES = ("lote", "dia", "cnpj")
+
+def combine_key(doc: NFCe, mode: str) -> str:
+    """Grupo da nota no PDF consolidado: lote inteiro, data de emissão ou CNPJ do emitente."""
+    if mode == "dia":
+        return doc.dhEmi[:10] or "sem_data"
+    if mode == "cnpj":
+        # CNPJ do emitente; na falta, o que está embutido na chave (posições 7-20)
+        return doc.emit.CNPJ or doc.chave[6:20] or "sem_cnpj"
+    return "lote"
+
+def render_combined(docs, out_pdf, paper="A4", bookmarks=False, timer=NO_TIMES):
+    """
+    Renderiza várias NFC-e num único PDF (mesmo layout de make_pdf; fontes e
+    recursos compartilhados). Com bookmarks=True, cada nota ganha uma entrada
+    no sumário (outline) do PDF.
+    """
+    page_w, page_h, _ = page_geometry(paper)
+    c = canvas.Canvas(str(out_pdf), pagesize=(page_w, page_h))
+    timer.start()
+    for i, doc in enumerate(docs):
+        if bookmarks:
+            key = f"nfce{i}"
+            c.bookmarkPage(key)
+            c.addOutlineEntry(f"{doc.dhEmi_str} {doc.chave or 'sem chave'}".strip(), key, level=0)
+        draw_danfe(c, doc, paper, timer)
+    if bookmarks:
+        c.showOutline()
+    with _pdf_save_lock:
+        c.save()
+    timer.lap("save")
+    return out_pdf
+
+# -------------------------
+# ESC/POS (impressora térmica, sem PDF)
+# -------------------------
+
+ESCPOS_COLUMNS = 48       # fonte A numa bobina de 80mm (576 pontos); 58mm: 32
+ESCPOS_CODEPAGE = 3       # ESC t 3 = PC860 (português)
+ESCPOS_ENCODING = "cp860"
+ESCPOS_QR_MODULE = 5      # tamanho do módulo do QR em pontos (1-16)
+ESCPOS_PORT = 9100        # porta RAW padrão das impressoras de rede
+
+ESC, GS = b"\x1b", b"\x1d"
+ESCPOS_INIT = ESC + b"@" + ESC + b"t" + bytes([ESCPOS_CODEPAGE])
+ESCPOS_CUT = ESC + b"d\x04" + GS + b"V\x01"  # avança 4 linhas e corta (corte parcial)
+
+def escpos_align(mode: str) -> bytes:
+    return ESC + b"a" + bytes([{"left": 0, "center": 1, "right": 2}[mode]])
+
+def escpos_bold(on: bool) -> bytes:
+    return ESC + b"E" + (b"\x01" if on else b"\x00")
+
+def escpos_qr(data: str, module: int = ESCPOS_QR_MODULE) -> bytes:
+    """QR Code nativo da impressora (GS ( k): modelo 2, correção M."""
+    payload = data.encode("ascii", "replace")
+    n = len(payload) + 3
+    return b"".join((
+        GS + b"(k\x04\x00\x31\x41\x32\x00",                  # modelo 2
+        GS + b"(k\x03\x00\x31\x43" + bytes([module]),        # tamanho do módulo
+        GS + b"(k\x03\x00\x31\x45\x31",                      # correção de erro M
+        GS + b"(k" + bytes([n & 0xFF, n >> 8]) + b"\x31\x50\x30" + payload,
+        GS + b"(k\x03\x00\x31\x51\x30",                      # imprime
+    ))
+
+def _lr(left: str, right: str, width: int) -> str:
+    """Texto à esquerda e valor à direita na mesma linha (corta o texto se preciso)."""
+    room = width - len(right) - 1
+    if room < 1:
+        return right[-width:]
+    return f"{left[:room]:<{room}} {right}"
+
+class EscPosBuilder:
+    """Acumula texto e comandos ESC/POS; o texto é codificado em PC860."""
+
+    def __init__(self, columns: int = ESCPOS_COLUMNS):
+        self.columns = columns
+        self.parts = [ESCPOS_INIT]
+
+    def raw(self, data: bytes):
+        self.parts.append(data)
+
+    def line(self, text: str = ""):
+        self.parts.append(text.encode(ESCPOS_ENCODING, "replace") + b"\n")
+
+    def wrapped(self, text: str, width: int | None = None):
+        for ln in textwrap.wrap(text, width or self.columns) or [""]:
+            self.line(ln)
+
+    def rule(self, ch: str = "-"):
+        self.line(ch * self.columns)
+
+    def getvalue(self) -> bytes:
+        return b"".join(self.parts)
+
+def render_escpos(source, columns: int = ESCPOS_COLUMNS, cut: bool = True) -> bytes:
+    """
+    Cupom em ESC/POS para impressora térmica: mesmos dados e blocos do DANFE
+    em PDF (cabeçalho, itens, totais, pagamentos, chave e QR), com texto
+    nativo da impressora e o QR pelo comando GS ( k, sem rasterizar nada.
+    `source`: o mesmo de render_pdf. Retorna os bytes prontos para enviar.
+    """
+    doc = as_nfce(source)
+    w = columns
+    p = EscPosBuilder(columns)
+    emit = doc.emit
+
+    # Cabeçalho: emitente
+    p.raw(escpos_align("center") + escpos_bold(True))
+    p.wrapped(emit.xFant or emit.xNome or "Emitente")
+    p.raw(escpos_bold(False))
+    for ln in emitter_address(emit.ender):
+        p.wrapped(ln)
+    p.wrapped(f"CNPJ: {emit.CNPJ}   IE: {emit.IE}")
+    p.wrapped(DANFE_TITLE)
+    p.raw(escpos_align("left"))
+    p.rule()
+
+    # Itens: código + descrição; na linha seguinte qtd x unitário = total
+    p.line(_lr("CÓD DESCRIÇÃO", "V.TOTAL", w))
+    p.rule()
+    for it in doc.itens:
+        p.wrapped(f"{it.cProd[:12]} {it.xProd}")
+        detalhe = f"{br_qty_text(it.qCom)} {it.uCom} x {br_money_text(it.vUnCom)}"
+        p.line(_lr(f"  {detalhe}", br_money_text(it.vProd), w))
+    p.rule()
+
+    # Totais
+    t = doc.totais
+    p.line(_lr("Qtde. total de itens", str(len(doc.itens)), w))
+    p.line(_lr("Valor dos Produtos", br_currency(t.vProd), w))
+    if t.vDesc:
+        p.line(_lr("Descontos", br_currency(t.vDesc), w))
+    if t.vOutro:
+        p.line(_lr("Outros", br_currency(t.vOutro), w))
+    p.raw(escpos_bold(True))
+    p.line(_lr("VALOR A PAGAR", br_currency(t.vNF), w))
+    p.raw(escpos_bold(False))
+
+    # Pagamentos
+    if doc.pag is not None:
+        p.line(_lr("FORMA DE PAGAMENTO", "VALOR PAGO", w))
+        for dp in doc.pag.detalhes:
+            meio = TPAG_MAP.get(dp.tPag, f"Código {dp.tPag}")
+            if dp.xPag:
+                meio = f"{meio} ({dp.xPag})"
+            p.line(_lr(meio, br_currency(dp.vPag), w))
+        if doc.pag.vTroco > 0:
+            p.line(_lr("Troco", br_currency(doc.pag.vTroco), w))
+    p.rule()
+
+    # Consumidor, emissão, chave e QR
+    p.raw(escpos_align("center"))
+    dest_doc = f" ({doc.dest.doc})" if doc.dest.doc else ""
+    p.wrapped(f"Consumidor: {doc.dest.xNome or 'Não informado'}{dest_doc}")
+    if doc.dhEmi_str:
+        p.line(f"Emissão: {doc.dhEmi_str}")
+    p.line("Consulte pela Chave de Acesso:")
+    p.wrapped(format_chave(doc.chave))
+    if doc.qr_url:
+        p.raw(escpos_qr(doc.qr_url))
+        p.line()
+    else:
+        p.line("QR Code não informado no XML.")
+    p.wrapped("DANFE NFC-e - Não é documento fiscal. Válido como representação simplificada da NFC-e.")
+    p.raw(escpos_align("left"))
+    if cut:
+        p.raw(ESCPOS_CUT)
+    return p.getvalue()
+
+def send_escpos(data: bytes, dest: str, timeout: float = 10.0):
+    """
+    Envia os bytes ESC/POS para `dest`: "tcp://host[:porta]" (impressora de
+    rede, porta RAW 9100) ou um caminho, seja arquivo comum ou dispositivo
+    (/dev/usb/lp0, compartilhamento \\\\PC\\impressora).
+    """
+    if dest.startswith("tcp://"):
+        host, _, port = dest[len("tcp://"):].rstrip("/").partition(":")
+        with socket.create_connection((host, int(port or ESCPOS_PORT)), timeout=timeout) as sock:
+            sock.sendall(data)
+        return
+    with open(dest, "wb") as f:
+        f.write(data)
+
+# -------------------------
+# Layout da saída (subpastas) e gravação atômica
+# -------------------------
+
+SHARD_MODES = ("dia", "mes", "ano", "cnpj", "prefixo")
+
+def shard_dir(doc: NFCe, mode: str | None) -> str:
+    """
+    Subpasta (relativa, separada por "/") de um arquivo no layout `mode`:
+    dia/mes/ano -> AAAA/MM/DD, AAAA/MM ou AAAA da emissão; cnpj -> CNPJ do
+    emitente (ou o embutido na chave); prefixo -> UF/AAMM da chave
+    (posições 1-2 e 3-6). Sem `mode`, "" (direto na pasta de saída).
+    """
+    if not mode:
+        return ""
+    if mode in ("dia", "mes", "ano"):
+        parts = doc.dhEmi[:10].split("-")
+        if len(parts) != 3 or not all(p.isdigit() for p in parts):
+            return "sem_data"
+        return "/".join(parts[:{"ano": 1, "mes": 2, "dia": 3}[mode]])
+    if mode == "cnpj":
+        return combine_key(doc, "cnpj")
+    if mode == "prefixo":
+        return f"{doc.chave[:2]}/{doc.chave[2:6]}" if len(doc.chave) >= 6 else "sem_chave"
+    raise ValueError(f"Layout de saída desconhecido: {mode} (use {', '.join(SHARD_MODES)})")
+
+@dataclass(frozen=True, slots=True)
+class OutputLayout:
+    """Como gravar os arquivos de um lote: subpastas (SHARD_MODES) e fsync."""
+    shard: str | None = None
+    fsync: int = 0  # 0: o SO decide; 1: cada arquivo antes do rename; N > 1: em lote, a cada N arquivos
+
+    def relpath(self, doc: NFCe, name: str) -> Path:
+        sub = shard_dir(doc, self.shard)
+        return Path(sub, name) if sub else Path(name)
+
+DEFAULT_LAYOUT = OutputLayout()
+
+def fsync_path(path):
+    """Força ao disco o conteúdo de um arquivo (ou a entrada de uma pasta)."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+@contextmanager
+def atomic_output(path: Path, fsync: bool = False):
+    """
+    Entrega um caminho temporário (<nome>.<pid>.tmp, na mesma pasta) e, se o
+    bloco terminar sem erro, renomeia para `path` com os.replace (atômico):
+    uma execução interrompida nunca deixa um arquivo truncado com o nome
+    final. fsync=True grava o conteúdo e a pasta no disco antes de seguir.
+    """
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    try:
+        yield tmp
+        if fsync:
+            fsync_path(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        raise
+    if fsync and os.name == "posix":
+        fsync_path(path.parent)
+
+class SyncBatch:
+    """
+    fsync em lote (OutputLayout.fsync > 1), no processo pai: a cada `every`
+    arquivos gravados, força esses arquivos e as pastas deles ao disco.
+    Entre um lote e outro, uma queda de energia pode perder os últimos
+    arquivos (nunca deixá-los truncados com o nome final).
+    """
+
+    def __init__(self, every: int):
+        self.every = every if every > 1 else 0
+        self.files = []
+
+    def add(self, path):
+        if not self.every:
+            return
+        self.files.append(path)
+        if len(self.files) >= self.every:
+            self.flush()
+
+    def flush(self):
+        dirs = set()
+        for p in self.files:
+            try:
+                fsync_path(p)
+            except OSError:
+                continue  # removido nesse meio-tempo
+            dirs.add(os.path.dirname(p))
+        if os.name == "posix":
+            for d in dirs:
+                fsync_path(d)
+        self.files.clear()
 
 def extract_chave_from_file(xml_path: Path) -> str:
     try:
-        tree = ET.parse(str(xml_path))
-        root = tree.getroot()
-        return robust_extract_chave(root)
+        return read_meta(xml_path, totals=False).chave
     except Exception:
         return ""
 
@@ -470,63 +1828,1457 @@ def is_xml_file(p: Path) -> bool:
 def ensure_dir(p: Path):
     p.mkdir(parents=True, exist_ok=True)
 
-def process_single_xml(xml_path: Path, out_dir: Path, paper: str, force_key_name: bool = True):
-    ensure_dir(out_dir)
-    chave = extract_chave_from_file(xml_path)
-    if not chave:
-        # fallback: usa o nome original do arquivo
-        stem = xml_path.stem
-        out_pdf = out_dir / f"{stem}.pdf"
-    else:
-        out_pdf = out_dir / f"{chave}.pdf"
-    make_pdf(str(xml_path), str(out_pdf), paper=paper)
+def process_single_xml(xml_path: Path, out_dir: Path, paper: str, force_key_name: bool = True, doc: NFCe | None = None,
+                       timer=NO_TIMES, layout: OutputLayout = DEFAULT_LAYOUT):
+    if doc is None:
+        doc = load_nfce(xml_path)
+    chave = doc.chave
+    # sem chave: usa o nome original do arquivo
+    out_pdf = out_dir / layout.relpath(doc, f"{chave or xml_path.stem}.pdf")
+    ensure_dir(out_pdf.parent)
+    with atomic_output(out_pdf, fsync=layout.fsync == 1) as tmp:
+        make_pdf(doc, str(tmp), paper=paper, timer=timer)
     return out_pdf
 
-def scan_xmls(in_dir: Path, pattern: str = "*.xml", recursive: bool = False):
-    if recursive:
-        files = list(in_dir.rglob(pattern))
+@dataclass
+class FileResult:
+    """Resultado da conversão de um XML (devolvido pelos workers ao processo pai)."""
+    xml_path: Path
+    out_pdf: Path | None = None
+    rows: ReceiptRows | None = None
+    error: str = ""
+    chave: str = ""
+    sha256: str = ""
+    doc: NFCe | None = None
+    timings: dict | None = None
+    pdf: bytes | None = None
+    proc: bool = False
+
+def convert_file(xml_path: Path, out_dir: Path, paper: str, want_rows: bool = False,
+                 want_hash: bool = False, profile: bool = False, to_bytes: bool = False,
+                 want_doc: bool = False, escpos: int | None = None,
+                 layout: OutputLayout = DEFAULT_LAYOUT) -> FileResult:
+    """
+    Converte um XML em PDF (e opcionalmente monta as linhas do Excel).
+    Nunca levanta exceção: erros voltam em FileResult.error, para que o
+    resultado possa atravessar o pool de processos. Com to_bytes=True o PDF
+    volta em FileResult.pdf (out_pdf é só o nome), para o processo pai
+    gravá-lo num .zip; com want_doc=True o modelo volta em FileResult.doc
+    (índice SQLite). escpos=N (colunas) gera <chave>.bin em ESC/POS em vez
+    do PDF. `layout` define a subpasta (também dentro do .zip) e o fsync.
+    """
+    timer = StageTimes() if profile else NO_TIMES
+    try:
+        sha = ""
+        if want_hash:
+            # lê o arquivo uma vez: o mesmo buffer serve ao hash e ao parse
+            data = xml_path.read_bytes() if isinstance(xml_path, ArchiveMember) else Path(xml_path).read_bytes()
+            sha = hashlib.sha256(data).hexdigest()
+            doc = nfce_from_root(ET.fromstring(data, xml_parser(), base_url=str(xml_path)))
+        else:
+            doc = load_nfce(xml_path)  # parse único por arquivo
+        timer.lap("parse")
+        pdf = None
+        if escpos:
+            out_pdf = layout.relpath(doc, f"{doc.chave or xml_path.stem}.bin")
+            pdf = render_escpos(doc, columns=escpos)
+            timer.lap("layout")
+            if not to_bytes:
+                out_pdf = out_dir / out_pdf
+                ensure_dir(out_pdf.parent)
+                with atomic_output(out_pdf, fsync=layout.fsync == 1) as tmp:
+                    tmp.write_bytes(pdf)
+                pdf = None
+        elif to_bytes:
+            out_pdf = layout.relpath(doc, f"{doc.chave or xml_path.stem}.pdf")
+            pdf = render_pdf(doc, paper=paper, timer=timer)
+        else:
+            out_pdf = process_single_xml(xml_path, out_dir, paper, force_key_name=True, doc=doc, timer=timer,
+                                         layout=layout)
+        timer.start()
+        rows = excel_rows(doc) if want_rows else None
+        if want_rows:
+            timer.lap("excel")
+        return FileResult(xml_path, out_pdf, rows, chave=doc.chave, sha256=sha, timings=timer.times, pdf=pdf,
+                          proc=doc.proc, doc=doc if want_doc else None)
+    except Exception as e:
+        return FileResult(xml_path, error=str(e), timings=timer.times)
+
+def _init_worker(font_regular=None, font_bold=None, huge_tree=False):
+    # Cada processo do pool registra as fontes uma única vez, antes do 1º arquivo
+    configure_fonts(font_regular, font_bold)
+    get_fonts()
+    configure_parser(huge_tree)
+
+def default_workers() -> int:
+    return os.cpu_count() or 1
+
+def _run_chunk(fn, chunk, consts):
+    return [fn(it, *consts) for it in chunk]
+
+def pool_map(fn, items, *consts, workers: int | None = None, font_regular=None, font_bold=None):
+    """
+    Aplica fn(item, *consts) a cada item e produz os resultados na MESMA ordem
+    da entrada. Com workers > 1 usa um pool de processos (renderização e QR
+    são CPU-bound); cada worker registra as fontes uma vez.
+
+    `items` pode ser um iterador preguiçoso (ex.: iter_xmls): ele é consumido
+    aos poucos, com no máximo workers*4 blocos em andamento, então o
+    processamento começa antes de a varredura terminar.
+    """
+    workers = workers or default_workers()
+    if hasattr(items, "__len__"):
+        workers = min(workers, len(items))
+        chunksize = max(1, min(32, len(items) // (max(workers, 1) * 4)))
     else:
-        files = list(in_dir.glob(pattern))
-    return [p for p in files if is_xml_file(p)]
+        chunksize = 4
+    if workers <= 1:
+        # No próprio processo: sem fontes explícitas, mantém as que o chamador
+        # já configurou (configure_fonts) em vez de voltar ao padrão
+        if font_regular or font_bold:
+            configure_fonts(font_regular, font_bold)
+        configure_parser(XML_HUGE_TREE)
+        for it in items:
+            yield fn(it, *consts)
+        return
+    it = iter(items)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(font_regular, font_bold, XML_HUGE_TREE)) as ex:
+        pending = deque()
 
-def process_directory(in_dir: Path, out_dir: Path, paper: str, glob: str, recursive: bool,
-                      log_fn=None, progress_fn=None, excel_path: Path | None = None):
-    ensure_dir(out_dir)
-    xmls = scan_xmls(in_dir, glob or "*.xml", recursive)
-    total = len(xmls)
+        def submit_next():
+            chunk = list(islice(it, chunksize))
+            if chunk:
+                pending.append(ex.submit(_run_chunk, fn, chunk, consts))
+            return bool(chunk)
+
+        try:
+            while len(pending) < workers * 4 and submit_next():
+                pass
+            while pending:
+                results = pending.popleft().result()
+                submit_next()
+                yield from results
+        finally:
+            # consumidor parou antes do fim (ex.: cancelamento): descarta os blocos ainda na fila
+            for fut in pending:
+                fut.cancel()
+
+def iter_convert(xmls, out_dir: Path, paper: str, want_rows: bool = False, workers: int | None = None,
+                 font_regular=None, font_bold=None, want_hash: bool = False, profile: bool = False,
+                 to_bytes: bool = False, want_doc: bool = False, escpos: int | None = None,
+                 layout: OutputLayout = DEFAULT_LAYOUT):
+    """Converte a lista de XMLs e produz FileResult na mesma ordem da entrada."""
+    yield from pool_map(convert_file, xmls, out_dir, paper, want_rows, want_hash, profile, to_bytes, want_doc, escpos,
+                        layout,
+                        workers=workers, font_regular=font_regular, font_bold=font_bold)
+
+def parse_file(xml_path: Path, want_rows: bool = False, profile: bool = False) -> FileResult:
+    """Só parseia (sem renderizar): usado pelo PDF consolidado."""
+    timer = StageTimes() if profile else NO_TIMES
+    try:
+        doc = load_nfce(xml_path)
+        timer.lap("parse")
+        rows = excel_rows(doc) if want_rows else None
+        if want_rows:
+            timer.lap("excel")
+        return FileResult(xml_path, rows=rows, chave=doc.chave, doc=doc, timings=timer.times)
+    except Exception as e:
+        return FileResult(xml_path, error=str(e))
+
+def render_group(group, paper: str, bookmarks: bool, profile: bool = False, fsync: bool = False):
+    """
+    Worker do PDF consolidado: group = (out_pdf, docs). fsync=True grava o
+    PDF no disco antes do rename (ver atomic_output).
+    Retorna (mensagem de erro ou "", tempos por etapa ou None).
+    """
+    out_pdf, docs = group
+    timer = StageTimes() if profile else NO_TIMES
+    try:
+        with atomic_output(out_pdf, fsync=fsync) as tmp:
+            render_combined(docs, tmp, paper=paper, bookmarks=bookmarks, timer=timer)
+        return "", timer.times
+    except Exception as e:
+        return str(e), timer.times
+
+MANIFEST_NAME = "nfce_manifest.jsonl"
+
+def file_sha256(path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+class Manifest:
+    """
+    Manifesto da conversão incremental (JSON lines em out_dir). Cada linha
+    registra um XML (caminho, tamanho, mtime, hash, chave, PDF, status); a
+    última linha de cada XML prevalece, então uma execução interrompida
+    retoma de onde parou.
+    """
+
+    def __init__(self, out_dir: Path):
+        self.path = out_dir / MANIFEST_NAME
+        self.entries = {}
+        self._lines = 0
+        if self.path.exists():
+            with open(self.path, encoding="utf-8") as f:
+                for ln in f:
+                    try:
+                        e = json.loads(ln)
+                    except ValueError:
+                        continue  # linha truncada por interrupção
+                    self.entries[e["xml"]] = e
+                    self._lines += 1
+        # Chaves cujos itens já foram exportados em execuções anteriores
+        self.exported = {e["chave"] for e in self.entries.values() if e.get("status") == "ok" and e.get("chave")}
+        self._fh = open(self.path, "a", encoding="utf-8")
+
+    @staticmethod
+    def key(xml_path) -> str:
+        return os.path.abspath(xml_path)
+
+    def is_current(self, xml_path: Path, st) -> bool:
+        """True se o XML já foi convertido com sucesso e não mudou desde então."""
+        e = self.entries.get(self.key(xml_path))
+        if e is None or e.get("status") != "ok" or e.get("size") != st.st_size:
+            return False
+        if not os.path.exists(e.get("pdf") or ""):
+            return False
+        if e.get("mtime_ns") == st.st_mtime_ns:
+            return True
+        # mtime mudou com o mesmo tamanho: confere o conteúdo antes de reconverter
+        if e.get("sha256") and file_sha256(xml_path) == e["sha256"]:
+            self._write(dict(e, mtime_ns=st.st_mtime_ns))
+            return True
+        return False
+
+    def record(self, res: FileResult, st):
+        e = {
+            "xml": self.key(res.xml_path),
+            "size": st.st_size if st is not None else None,
+            "mtime_ns": st.st_mtime_ns if st is not None else None,
+            "sha256": res.sha256,
+            "chave": res.chave,
+            "proc": res.proc,
+            "pdf": os.path.abspath(res.out_pdf) if res.out_pdf else "",
+            "status": "falha" if res.error else "ok",
+        }
+        if res.error:
+            e["erro"] = res.error
+        self._write(e)
+
+    def converted_by_chave(self) -> dict:
+        """chave -> entrada dos XMLs convertidos com sucesso (PDF ainda presente)."""
+        return {
+            e["chave"]: e for e in self.entries.values()
+            if e.get("status") == "ok" and e.get("chave") and os.path.exists(e.get("pdf") or "")
+        }
+
+    def _write(self, e):
+        self.entries[e["xml"]] = e
+        self._lines += 1
+        self._fh.write(json.dumps(e, ensure_ascii=False) + "\n")
+        self._fh.flush()
+
+    def close(self):
+        self._fh.close()
+        # Compacta: mantém só a última linha de cada XML
+        if self._lines > len(self.entries):
+            tmp = self.path.with_suffix(".tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                for e in self.entries.values():
+                    f.write(json.dumps(e, ensure_ascii=False) + "\n")
+            os.replace(tmp, self.path)
+
+# -------------------------
+# Entrada em arquivos compactados (.zip / .tar*)
+# -------------------------
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+def is_archive(p) -> bool:
+    return str(p).lower().endswith(ARCHIVE_SUFFIXES)
+
+@dataclass(frozen=True, slots=True, eq=False)
+class ArchiveMember:
+    """
+    XML lido de dentro de um .zip/.tar. Não existe no disco: o conteúdo viaja
+    junto até o worker e vai direto para o parser. Imita o que o resto do
+    código usa de Path (name, stem, read_bytes).
+    """
+    archive: Path
+    member: str
+    data: bytes
+
+    @property
+    def name(self) -> str:
+        return PurePosixPath(self.member).name
+
+    @property
+    def stem(self) -> str:
+        return PurePosixPath(self.member).stem
+
+    def read_bytes(self) -> bytes:
+        return self.data
+
+    def __str__(self):
+        return f"{self.archive}!{self.member}"
+
+def member_matches(name: str, pattern: str) -> bool:
+    """--glob aplicado ao nome do membro (com "/" no padrão, ao caminho dentro do arquivo)."""
+    if not name.lower().endswith(".xml"):
+        return False
+    if "/" in pattern or "**" in pattern:
+        return PurePosixPath(name).match(pattern)
+    return fnmatch(PurePosixPath(name).name, pattern)
+
+def iter_archive(archive: Path, pattern: str = "*.xml"):
+    """
+    Produz os XMLs de um .zip/.tar sem extrair nada no disco. O .tar é lido
+    em modo stream (sequencial), o que serve também para .tar.gz grandes.
+    """
+    archive = Path(archive)
+    if archive.name.lower().endswith(".zip"):
+        with zipfile.ZipFile(archive) as zf:
+            for info in zf.infolist():
+                if not info.is_dir() and member_matches(info.filename, pattern):
+                    yield ArchiveMember(archive, info.filename, zf.read(info))
+        return
+    with tarfile.open(archive, mode="r|*") as tf:
+        for m in tf:
+            if m.isfile() and member_matches(m.name, pattern):
+                yield ArchiveMember(archive, m.name, tf.extractfile(m).read())
+
+def expand_archives(paths, pattern: str = "*.xml"):
+    """Troca cada .zip/.tar da sequência pelos XMLs de dentro dele."""
+    for p in paths:
+        if is_archive(p):
+            yield from iter_archive(p, pattern)
+        else:
+            yield p
+
+def iter_inputs(entrada: Path, pattern: str = "*.xml", recursive: bool = False, sort: bool = False):
+    """
+    XMLs de um diretório (inclusive dentro dos .zip/.tar que ele contém) ou
+    de um único arquivo compactado. sort=True ordena os arquivos do
+    diretório; os membros de cada arquivo compactado seguem a ordem interna.
+    """
+    pattern = pattern or "*.xml"
+    if not Path(entrada).is_dir():
+        return iter_archive(entrada, pattern)
+    source = iter_xmls(entrada, pattern, recursive, archives=True)
+    if sort:
+        source = sorted(source)
+        if not any(map(is_archive, source)):
+            return source  # lista: o total já é conhecido
+    return expand_archives(source, pattern)
+
+class PdfZipWriter:
+    """
+    Grava os PDFs num único .zip de saída (no processo pai). Os PDFs já são
+    comprimidos, então vão sem recompressão (ZIP_STORED). Nomes repetidos
+    ganham sufixo _2, _3...; o arquivo só aparece no destino ao fechar.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._tmp = self.path.with_name(self.path.name + ".tmp")
+        self._zf = zipfile.ZipFile(self._tmp, "w", zipfile.ZIP_STORED)
+        self._names = set()
+
+    def add(self, name: str, data: bytes) -> str:
+        stem, suffix = os.path.splitext(name)
+        k = 2
+        while name in self._names:
+            name = f"{stem}_{k}{suffix}"
+            k += 1
+        self._names.add(name)
+        self._zf.writestr(name, data)
+        return name
+
+    def __len__(self):
+        return len(self._names)
+
+    def close(self):
+        self._zf.close()
+        os.replace(self._tmp, self.path)
+
+def iter_xmls(in_dir: Path, pattern: str = "*.xml", recursive: bool = False, archives: bool = False):
+    """
+    Produz os XMLs à medida que são encontrados (os.scandir, sem montar a
+    lista inteira). O tipo de cada entrada vem do DirEntry, sem stat extra.
+    Padrões com subpasta ("sub/*.xml", "**") usam o glob do pathlib.
+    archives=True produz também os .zip/.tar encontrados (ver expand_archives).
+    """
+    if "/" in pattern or os.sep in pattern or "**" in pattern:
+        found = in_dir.rglob(pattern) if recursive else in_dir.glob(pattern)
+        yield from (p for p in found if is_xml_file(p))
+        return
+    stack = [str(in_dir)]
+    while stack:
+        subdirs = []
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for e in entries:
+                    try:
+                        if e.is_file():
+                            if e.name.lower().endswith(".xml") and fnmatch(e.name, pattern):
+                                yield Path(e.path)
+                            elif archives and is_archive(e.name):
+                                yield Path(e.path)
+                        elif recursive and e.is_dir(follow_symlinks=False):
+                            subdirs.append(e.path)
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+        stack.extend(reversed(subdirs))
+
+def scan_xmls(in_dir: Path, pattern: str = "*.xml", recursive: bool = False):
+    return list(iter_xmls(in_dir, pattern, recursive))
+
+class ScanCounter:
+    """Conta os itens de uma varredura preguiçosa; `total` só vale quando `done`."""
+
+    def __init__(self, source):
+        self._source = source
+        self.total = len(source) if hasattr(source, "__len__") else 0
+        self.done = hasattr(source, "__len__")
+
+    def __iter__(self):
+        if self.done:
+            yield from self._source
+            return
+        for item in self._source:
+            self.total += 1
+            yield item
+        self.done = True
+
+def _write_items(items, res: FileResult, prof=None):
+    """Grava as linhas do arquivo e registra o perfil (a gravação conta na etapa "excel")."""
+    if prof is None:
+        items.write(res.rows)
+        return
+    t = time.perf_counter()
+    items.write(res.rows)
+    if res.rows is not None:
+        res.timings["excel"] = res.timings.get("excel", 0.0) + time.perf_counter() - t
+    prof.add(res.xml_path.name, res.timings)
+
+def _process_combined(xmls, out_dir: Path, paper: str, combine: str, bookmarks: bool, items,
+                      workers, font_regular, font_bold, log_fn=None, report=None, prof=None, index=None,
+                      stop_event=None, layout: OutputLayout | None = None, sync: SyncBatch | None = None):
+    """
+    PDF consolidado: 1) parseia em paralelo; 2) agrupa as notas (lote, dia ou
+    CNPJ), em ordem de emissão; 3) renderiza cada grupo num único PDF, com os
+    grupos distribuídos entre os workers. O fsync segue layout.fsync (1: no
+    worker, antes do rename; N > 1: em lote, via `sync`). Retorna (ok, fail).
+    """
+    layout = layout or DEFAULT_LAYOUT
     ok, fail = 0, 0
-    rows_accum = []
+    groups = {}
+    results = pool_map(parse_file, xmls, bool(items), prof is not None, workers=workers,
+                       font_regular=font_regular, font_bold=font_bold)
+    for idx, res in enumerate(results, start=1):
+        if res.error:
+            fail += 1
+            if log_fn:
+                log_fn(f"[FALHA] {res.xml_path.name}: {res.error}")
+        else:
+            groups.setdefault(combine_key(res.doc, combine), []).append((res.doc, str(res.xml_path)))
+            _write_items(items, res, prof)
+        if report:
+            report(idx)
+    if stop_event is not None and stop_event.is_set():
+        return ok, fail  # cancelado: grupos incompletos não viram PDF
+
+    jobs, origins = [], []
+    for key in sorted(groups):
+        entries = sorted(groups[key], key=lambda e: e[0].dhEmi)
+        jobs.append((out_dir / f"NFCe_{key}.pdf", [doc for doc, _ in entries]))
+        origins.append([xml for _, xml in entries])
+    rendered = pool_map(render_group, jobs, paper, bookmarks, prof is not None, layout.fsync == 1,
+                        workers=workers, font_regular=font_regular, font_bold=font_bold)
+    for (out_pdf, docs), (err, times), xmls_group in zip(jobs, rendered, origins):
+        if prof is not None:
+            prof.add(out_pdf.name, times, kind="grupo")
+        if err:
+            fail += len(docs)
+            if log_fn:
+                log_fn(f"[FALHA] {out_pdf.name}: {err}")
+        else:
+            ok += len(docs)
+            if log_fn:
+                log_fn(f"[OK] {len(docs)} nota(s) -> {out_pdf.name}")
+            if sync is not None:
+                sync.add(out_pdf)
+            if index is not None:
+                for doc, xml in zip(docs, xmls_group):
+                    index.add(doc, out_pdf.resolve(), xml)
+    return ok, fail
+
+# -------------------------
+# Índice local (SQLite)
+# -------------------------
+
+INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS notas (
+    chave TEXT PRIMARY KEY,
+    dhEmi TEXT,
+    data TEXT,              -- AAAA-MM-DD (data local da emissão)
+    cnpj TEXT,
+    emitente TEXT,
+    consumidor_doc TEXT,
+    vnf REAL,
+    tpags TEXT,             -- códigos tPag separados por vírgula
+    pagamentos TEXT,        -- descrições (TPAG_MAP)
+    pdf TEXT,
+    xml TEXT,
+    nfeproc INTEGER
+);
+CREATE TABLE IF NOT EXISTS itens (
+    chave TEXT NOT NULL,
+    n INTEGER NOT NULL,
+    cprod TEXT,
+    xprod TEXT,
+    qcom REAL,
+    ucom TEXT,
+    vuncom REAL,
+    vprod REAL,
+    PRIMARY KEY (chave, n)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS notas_data ON notas(data);
+CREATE INDEX IF NOT EXISTS notas_cnpj ON notas(cnpj, data);
+CREATE INDEX IF NOT EXISTS itens_cprod ON itens(cprod);
+"""
+
+INDEX_COLUMNS = ["CHAVE", "EMISSAO", "CNPJ", "EMITENTE", "CONSUMIDOR", "VNF", "PAGAMENTOS", "PDF"]
+
+class ReceiptIndex:
+    """
+    Índice SQLite das notas convertidas: cabeçalho (tabela notas) e itens
+    (tabela itens). Reconverter a mesma chave substitui o registro. As
+    gravações são agrupadas em transações de INDEX_BATCH notas.
+    """
+    INDEX_BATCH = 500
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path))
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(INDEX_SCHEMA)
+        self.inserted = 0  # chaves novas no índice
+        self.replaced = 0  # chaves que já existiam (reconversão ou duplicata)
+        self._pending = 0
+
+    def add(self, doc: NFCe, pdf="", xml=""):
+        if not doc.chave:
+            return  # sem chave não há como identificar a nota
+        detalhes = doc.pag.detalhes if doc.pag is not None else ()
+        tpags = ",".join(dp.tPag for dp in detalhes)
+        meios = "; ".join(TPAG_MAP.get(dp.tPag, f"Código {dp.tPag}") for dp in detalhes)
+        exists = self.conn.execute("SELECT 1 FROM notas WHERE chave = ?", (doc.chave,)).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO notas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (doc.chave, doc.dhEmi, doc.dhEmi[:10], doc.emit.CNPJ, doc.emit.xFant or doc.emit.xNome,
+             doc.dest.doc, float(doc.totais.vNF), tpags, meios, str(pdf or ""), str(xml or ""), int(doc.proc)),
+        )
+        self.conn.execute("DELETE FROM itens WHERE chave = ?", (doc.chave,))
+        self.conn.executemany(
+            "INSERT INTO itens VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [(doc.chave, n, it.cProd, it.xProd, _to_float(it.qCom), it.uCom, _to_float(it.vUnCom), _to_float(it.vProd))
+             for n, it in enumerate(doc.itens, start=1)],
+        )
+        if exists:
+            self.replaced += 1
+        else:
+            self.inserted += 1
+        self._pending += 1
+        if self._pending >= self.INDEX_BATCH:
+            self.conn.commit()
+            self._pending = 0
+
+    def query(self, date_from=None, date_to=None, cnpj=None, min_value=None, max_value=None, product=None):
+        """Notas que atendem a todos os filtros informados, em ordem de emissão."""
+        where, params = [], []
+        if date_from:
+            where.append("data >= ?"); params.append(date_from)
+        if date_to:
+            where.append("data <= ?"); params.append(date_to)
+        if cnpj:
+            where.append("cnpj = ?"); params.append("".join(ch for ch in cnpj if ch.isdigit()))
+        if min_value is not None:
+            where.append("vnf >= ?"); params.append(float(min_value))
+        if max_value is not None:
+            where.append("vnf <= ?"); params.append(float(max_value))
+        if product:
+            where.append("chave IN (SELECT chave FROM itens WHERE cprod = ?)"); params.append(product)
+        sql = "SELECT * FROM notas"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY dhEmi, chave"
+        return self.conn.execute(sql, params).fetchall()
+
+    def receipt_rows(self, nota) -> ReceiptRows:
+        """Itens de uma nota (linha de query) no formato da exportação Excel/CSV/Parquet."""
+        cur = self.conn.execute(
+            "SELECT cprod, xprod, qcom, ucom, vuncom, vprod FROM itens WHERE chave = ? ORDER BY n", (nota["chave"],)
+        )
+        return ReceiptRows(format_dhEmi(nota["dhEmi"]), nota["chave"], tuple(ItemRow(*r) for r in cur))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def query_index(index_path: Path, filters: dict, items_paths=(), copy_pdfs: Path | None = None,
+                list_items: bool = False, out=None, log_fn=None):
+    """
+    Consulta o índice: lista as notas (ou, com list_items, os itens) em CSV,
+    exporta os itens das notas encontradas (Excel/CSV/Parquet) e/ou copia os
+    PDFs para copy_pdfs, sem reler nenhum XML. Retorna o nº de notas.
+    """
+    out = out or sys.stdout
+    if not Path(index_path).exists():
+        raise FileNotFoundError(f"Índice não encontrado: {index_path}")
+    index = ReceiptIndex(index_path)
+    try:
+        notas = index.query(**filters)
+        w = csv.writer(out)
+        w.writerow(EXCEL_COLUMNS if list_items else INDEX_COLUMNS)
+        export = ItemsExport(items_paths, log_fn=log_fn)
+        for nota in notas:
+            rows = index.receipt_rows(nota) if (list_items or export) else None
+            if list_items:
+                w.writerows(rows.values())
+            else:
+                w.writerow([nota["chave"], format_dhEmi(nota["dhEmi"]), nota["cnpj"], nota["emitente"],
+                            nota["consumidor_doc"], f"{nota['vnf']:.2f}", nota["pagamentos"], nota["pdf"]])
+            export.write(rows)
+        export.close()
+    finally:
+        index.close()
+    if copy_pdfs is not None:
+        ensure_dir(copy_pdfs)
+        copied, missing = 0, 0
+        for pdf in dict.fromkeys(n["pdf"] for n in notas):  # PDF consolidado aparece uma vez
+            if pdf and os.path.isfile(pdf):
+                shutil.copy2(pdf, copy_pdfs)
+                copied += 1
+            else:
+                missing += 1
+        if log_fn:
+            log_fn(f"[PDF] {copied} PDF(s) copiados para: {copy_pdfs}" + (f" ({missing} não encontrados)" if missing else ""))
     if log_fn:
-        log_fn(f"Encontrados {total} XML(s) em {in_dir} (padrão: {glob}, recursivo: {recursive})")
-    for idx, xp in enumerate(sorted(xmls), start=1):
-        try:
-            out_pdf = process_single_xml(xp, out_dir, paper, force_key_name=True)
-            ok += 1
+        log_fn(f"[RESUMO] {len(notas)} nota(s) encontradas")
+    return len(notas)
+
+# -------------------------
+# Duplicados (mesma chave de acesso)
+# -------------------------
+
+def dedup_key(xml_path):
+    """Worker da 1ª passada do dedup: (id do XML, chave, nfeProc). Erro -> chave vazia."""
+    try:
+        meta = read_meta(xml_path, totals=False)
+        return str(xml_path), meta.chave, meta.proc
+    except Exception:
+        return str(xml_path), "", False
+
+def select_unique(source, workers: int | None = None, font_regular=None, font_bold=None,
+                  manifest: "Manifest | None" = None):
+    """
+    1ª passada do dedup: lê só o cabeçalho de cada XML (read_meta sem
+    totais) e escolhe uma cópia por chave. O XML de distribuição (nfeProc,
+    com o protocolo de autorização) ganha da NFe "pura"; entre cópias do
+    mesmo tipo fica a primeira encontrada. Com o manifesto incremental, uma
+    chave já convertida por outro arquivo em execução anterior também conta
+    como duplicada (a menos que a cópia nova seja nfeProc e a antiga não).
+
+    Retorna (ids a manter, [(id descartado, chave, id mantido)]). XMLs sem
+    chave legível são mantidos: a falha aparece na conversão.
+    """
+    best = {}    # chave -> (nfeProc, id)
+    keep = set()
+    dups = []
+    prior = manifest.converted_by_chave() if manifest is not None else {}
+    for sid, chave, proc in pool_map(dedup_key, source, workers=workers,
+                                     font_regular=font_regular, font_bold=font_bold):
+        if not chave:
+            keep.add(sid)
+            continue
+        old = prior.get(chave)
+        if old is not None and old["xml"] != Manifest.key(sid) and (old.get("proc") or not proc):
+            dups.append((sid, chave, old["xml"]))
+            continue
+        cur = best.get(chave)
+        if cur is None:
+            best[chave] = (proc, sid)
+        elif proc and not cur[0]:
+            dups.append((cur[1], chave, sid))
+            best[chave] = (proc, sid)
+        else:
+            dups.append((sid, chave, cur[1]))
+    keep.update(sid for _, sid in best.values())
+    return keep, dups
+
+def process_directory(in_dir: Path, out_dir: Path, paper: str, glob: str, recursive: bool,
+                      log_fn=None, progress_fn=None, excel_path: Path | None = None,
+                      workers: int | None = None, font_regular=None, font_bold=None,
+                      incremental: bool = False, csv_path: Path | None = None,
+                      parquet_path: Path | None = None, combine: str | None = None,
+                      bookmarks: bool = False, sort: bool = False, profile: bool = False,
+                      profile_path: Path | None = None, dedup: bool = False,
+                      index_path: Path | None = None, stop_event: threading.Event | None = None,
+                      escpos: int | None = None, layout: OutputLayout | None = None):
+    """
+    Converte os XMLs de in_dir. Por padrão a conversão começa enquanto a
+    varredura ainda está em andamento (ordem do sistema de arquivos) e
+    progress_fn recebe total=None até a varredura terminar; sort=True varre
+    tudo antes e processa em ordem de nome (reprodutível).
+
+    in_dir pode ser um .zip/.tar (ou conter arquivos compactados): os XMLs
+    são lidos de dentro deles, sem extrair. out_dir terminado em .zip grava
+    os PDFs dentro desse .zip em vez de numa pasta.
+
+    dedup=True faz antes uma passada leve (só o cabeçalho de cada XML) e
+    converte uma única cópia por chave de acesso (ver select_unique); as
+    cópias descartadas aparecem no log e no resumo.
+
+    index_path: grava cabeçalho e itens de cada nota convertida num índice
+    SQLite (ver ReceiptIndex), para consultas e reimpressão sem reprocessar.
+
+    stop_event: quando sinalizado, nenhum XML novo é enviado aos workers,
+    os blocos ainda na fila são descartados e o lote termina normalmente
+    (Excel, manifesto e índice fechados com o que já foi convertido).
+
+    escpos=N: em vez de PDFs, grava um <chave>.bin em ESC/POS (N colunas)
+    por XML, pronto para enviar à impressora térmica (ver render_escpos).
+
+    layout (OutputLayout): subpastas por data de emissão, CNPJ ou prefixo
+    da chave, para não acumular centenas de milhares de arquivos numa pasta
+    só, e fsync (por arquivo ou em lote). Cada arquivo é gravado num .tmp e
+    renomeado ao final, então uma queda nunca deixa PDF truncado.
+    """
+    zip_out = out_dir.suffix.lower() == ".zip"
+    if zip_out and combine:
+        raise ValueError("O PDF consolidado (--combine) não grava em .zip; informe um diretório de saída")
+    if escpos and combine:
+        raise ValueError("--combine gera PDF; não se aplica à saída ESC/POS")
+    layout = layout or DEFAULT_LAYOUT
+    if combine and layout.shard and log_fn:
+        log_fn("[AVISO] Subpastas (--shard) não se aplicam ao PDF consolidado; os PDFs ficam em " + str(out_dir))
+    ensure_dir(out_dir.parent if zip_out else out_dir)
+    if combine and incremental:
+        incremental = False
+        if log_fn:
+            log_fn("[AVISO] Modo incremental não se aplica ao PDF consolidado; todos os XMLs serão processados.")
+    if zip_out and incremental:
+        incremental = False
+        if log_fn:
+            log_fn("[AVISO] Modo incremental não se aplica à saída em .zip; todos os XMLs serão processados.")
+
+    # Modo incremental: pula (só com stat) o que já está no manifesto e não mudou
+    manifest = Manifest(out_dir) if incremental else None
+    stats = {}
+
+    source = iter_inputs(in_dir, glob, recursive, sort)
+    dups = []
+    if dedup:
+        if log_fn:
+            log_fn(f"[DEDUP] Lendo as chaves de acesso em {in_dir}...")
+        keep, dups = select_unique(source, workers, font_regular, font_bold, manifest)
+        if log_fn:
+            for sid, chave, kept in dups:
+                log_fn(f"[DUPLICADO] {sid}: chave {chave} já coberta por {kept}")
+        if isinstance(source, list):
+            source = [xp for xp in source if str(xp) in keep]
+        else:
+            # 2ª varredura (os .zip/.tar são relidos; os XMLs descartados, ignorados)
+            source = (xp for xp in iter_inputs(in_dir, glob, recursive, sort) if str(xp) in keep)
+    scan = ScanCounter(source)
+    ok, fail, skipped = 0, 0, 0
+    # Itens gravados em streaming: memória constante, independente do lote
+    # No incremental, as linhas desta execução se somam às das anteriores
+    items = ItemsExport([excel_path, csv_path, parquet_path], log_fn=log_fn, append=incremental)
+    if log_fn:
+        if scan.done:
+            log_fn(f"Encontrados {scan.total + len(dups)} XML(s) em {in_dir} (padrão: {glob}, recursivo: {recursive})")
+        else:
+            log_fn(f"Varrendo {in_dir} (padrão: {glob}, recursivo: {recursive}); a conversão começa durante a varredura")
+
+    def report(done):
+        if progress_fn:
+            progress_fn(done, scan.total if scan.done else None)
+
+    # Perfil por etapa (parse, layout, qr, save, excel); JSON lines opcional
+    prof = ProfileReport(profile_path) if (profile or profile_path) else None
+    index = ReceiptIndex(index_path) if index_path else None
+
+    def pending():
+        nonlocal skipped
+        for xp in scan:
+            if stop_event is not None and stop_event.is_set():
+                return
+            # XMLs de dentro de .zip/.tar não têm stat: ficam fora do manifesto
+            if manifest is not None and not isinstance(xp, ArchiveMember):
+                try:
+                    st = xp.stat()
+                except OSError:
+                    st = None
+                if st is not None and manifest.is_current(xp, st):
+                    skipped += 1
+                    if skipped % 1000 == 0:
+                        report(skipped + ok + fail)
+                    continue
+                stats[xp] = st
+            yield xp
+
+    pdf_zip = PdfZipWriter(out_dir) if zip_out else None
+    sync = SyncBatch(0 if zip_out else layout.fsync)
+    try:
+        if combine:
+            ok, fail = _process_combined(pending(), out_dir, paper, combine, bookmarks, items,
+                                         workers, font_regular, font_bold, log_fn, report, prof, index,
+                                         stop_event, layout, sync)
+        else:
+            results = iter_convert(pending(), out_dir, paper, want_rows=bool(items), workers=workers,
+                                   font_regular=font_regular, font_bold=font_bold,
+                                   want_hash=manifest is not None, profile=prof is not None,
+                                   to_bytes=zip_out, want_doc=index is not None, escpos=escpos,
+                                   layout=layout)
+            for res in results:
+                xp = res.xml_path
+                if res.error:
+                    fail += 1
+                    if log_fn:
+                        log_fn(f"[FALHA] {xp.name}: {res.error}")
+                else:
+                    ok += 1
+                    if pdf_zip is not None:
+                        res.out_pdf = Path(pdf_zip.add(res.out_pdf.as_posix(), res.pdf))
+                        res.pdf = None
+                    else:
+                        sync.add(res.out_pdf)
+                    again = manifest is not None and res.chave in manifest.exported
+                    if again:
+                        res.rows = None  # reconvertido: os itens já estão no Excel/CSV/Parquet
+                    if log_fn:
+                        note = " (reconvertido: itens já exportados)" if again and items else ""
+                        log_fn(f"[OK] {xp.name} -> {res.out_pdf.name}{note}")
+                    # Itens para Excel/CSV/Parquet
+                    _write_items(items, res, prof)
+                    if index is not None:
+                        pdf = f"{out_dir.resolve()}!{res.out_pdf.as_posix()}" if zip_out else res.out_pdf.resolve()
+                        index.add(res.doc, pdf, xp)
+                        res.doc = None
+                if manifest is not None and not isinstance(xp, ArchiveMember):
+                    manifest.record(res, stats.pop(xp, None))
+                report(skipped + ok + fail)
+                if stop_event is not None and stop_event.is_set():
+                    break
+            results.close()
+    finally:
+        sync.flush()
+        if pdf_zip is not None:
+            pdf_zip.close()
             if log_fn:
-                log_fn(f"[OK] {xp.name} -> {out_pdf.name}")
-            # Coleta itens para Excel
-            if excel_path is not None:
-                rows_accum.extend(parse_items_for_excel(xp))
-        except Exception as e:
+                log_fn(f"[ZIP] {len(pdf_zip)} PDF(s) gravados em: {out_dir}")
+        if manifest is not None:
+            manifest.close()
+        items.close()
+        if prof is not None:
+            prof.close()
+        if index is not None:
+            index.close()
+            if log_fn:
+                log_fn(f"[INDICE] {index.inserted} nota(s) nova(s), {index.replaced} substituída(s) em: {index_path}")
+    total = scan.total + len(dups)
+    cancelled = stop_event is not None and stop_event.is_set()
+    if progress_fn and not cancelled:
+        progress_fn(scan.total, scan.total)
+    if log_fn:
+        if cancelled:
+            log_fn(f"[CANCELADO] Interrompido após {ok + fail} XML(s) convertidos")
+        elif not sort:
+            log_fn(f"Encontrados {total} XML(s) em {in_dir}")
+        parts = [f"Sucesso: {ok}", f"Falhas: {fail}"]
+        if incremental:
+            log_fn(f"[INCREMENTAL] {skipped} XML(s) sem alteração ignorados")
+            parts.append(f"Ignorados: {skipped}")
+        if dedup:
+            log_fn(f"[DEDUP] {len(dups)} XML(s) duplicado(s) descartado(s)")
+            parts.append(f"Duplicados: {len(dups)}")
+        log_fn(f"[RESUMO] {' | '.join(parts)} | Total: {total}")
+        if prof is not None:
+            log_fn(f"[RESUMO] Etapas: {prof.breakdown()}")
+            if profile_path:
+                log_fn(f"[PERFIL] Tempos por arquivo em: {profile_path}")
+    return ok, fail, total
+
+META_COLUMNS = ["ARQUIVO", "CHAVE", "EMISSAO", "CNPJ", "VNF", "NFEPROC"]
+
+def meta_file(xml_path):
+    """Worker do --dry-run: (xml_path, NFCeMeta ou None, erro)."""
+    try:
+        return xml_path, read_meta(xml_path), ""
+    except Exception as e:
+        return xml_path, None, str(e)
+
+def dry_run(entrada: Path, glob: str = "*.xml", recursive: bool = False, sort: bool = False,
+            workers: int | None = None, out=None, log_fn=None):
+    """
+    Lista os XMLs (inclusive de dentro de .zip/.tar) com chave, emissão,
+    CNPJ e vNF, em CSV, sem parse completo e sem gerar PDF. Retorna (ok, fail).
+    """
+    out = out or sys.stdout
+    w = csv.writer(out)
+    w.writerow(META_COLUMNS)
+    ok, fail, total_vnf = 0, 0, Decimal("0.00")
+    source = iter_inputs(entrada, glob, recursive, sort) if (entrada.is_dir() or is_archive(entrada)) else [entrada]
+    for xp, meta, err in pool_map(meta_file, source, workers=workers):
+        if err:
             fail += 1
             if log_fn:
-                log_fn(f"[FALHA] {xp.name}: {e}")
-        if progress_fn:
-            progress_fn(idx, total)
-    # Exporta Excel se solicitado
-    if excel_path is not None:
+                log_fn(f"[FALHA] {xp.name}: {err}")
+            continue
+        ok += 1
+        total_vnf += meta.vNF
+        w.writerow([str(xp), meta.chave, meta.dhEmi_str, meta.CNPJ, f"{meta.vNF:.2f}", "S" if meta.proc else "N"])
+    if log_fn:
+        log_fn(f"[RESUMO] XMLs: {ok} | Falhas: {fail} | Valor total: R$ {br_currency(total_vnf)}")
+    return ok, fail
+
+# =========================
+# Modo watch (pasta monitorada)
+# =========================
+
+WATCH_DEBOUNCE = 2.0       # segundos sem alteração antes de converter
+WATCH_POLL_INTERVAL = 2.0  # intervalo da varredura no modo polling
+
+def matches_pattern(path: Path, root: Path, pattern: str) -> bool:
+    """Mesmo critério de iter_xmls para um caminho vindo de um evento."""
+    if not path.name.lower().endswith(".xml"):
+        return False
+    if "/" in pattern or os.sep in pattern or "**" in pattern:
         try:
-            export_excel(rows_accum, excel_path, log_fn=log_fn)
-        except Exception as ee:
-            if log_fn: log_fn(f"[ERRO EXCEL] {ee}")
+            return path.relative_to(root).match(pattern)
+        except ValueError:
+            return False
+    return fnmatch(path.name, pattern)
+
+class InotifyWatcher:
+    """
+    Eventos do kernel (Linux, inotify via ctypes). IN_CLOSE_WRITE e
+    IN_MOVED_TO indicam arquivo fechado pelo escritor / movido para a pasta,
+    ou seja, completo. poll() retorna (arquivos, pastas a varrer): pastas
+    novas (recursivo) e estouro da fila do kernel pedem varredura.
+    """
+    kind = "inotify"
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+    _EVENT = struct.Struct("iIII")
+
+    def __init__(self, root: Path, recursive: bool = False):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify só existe no Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 falhou")
+        self.root = Path(root)
+        self.recursive = recursive
+        self.dirs = {}
+        self._add_dir(self.root, strict=True)
+
+    def _add_dir(self, d: Path, strict=False):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | (self.IN_CREATE if self.recursive else 0)
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(str(d)), mask)
+        if wd < 0:
+            if strict:
+                raise OSError(ctypes.get_errno(), f"inotify_add_watch falhou: {d}")
+            return
+        self.dirs[wd] = d
+        if self.recursive:
+            try:
+                with os.scandir(d) as entries:
+                    subdirs = [Path(e.path) for e in entries if e.is_dir(follow_symlinks=False)]
+            except OSError:
+                return
+            for sub in subdirs:
+                self._add_dir(sub)
+
+    def poll(self, timeout: float):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return [], []
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return [], []
+        files, rescan = [], []
+        off = 0
+        while off < len(data):
+            wd, mask, _cookie, ln = self._EVENT.unpack_from(data, off)
+            off += self._EVENT.size
+            name = data[off:off + ln].rstrip(b"\0")
+            off += ln
+            if mask & self.IN_Q_OVERFLOW:
+                rescan.append(self.root)
+                continue
+            base = self.dirs.get(wd)
+            if base is None or not name:
+                continue
+            p = base / os.fsdecode(name)
+            if mask & self.IN_ISDIR:
+                if self.recursive:
+                    # arquivos criados antes da inscrição da pasta só aparecem na varredura
+                    self._add_dir(p)
+                    rescan.append(p)
+            else:
+                files.append(p)
+        return files, rescan
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    """
+    Alternativa portátil (Windows/macOS, compartilhamentos de rede, onde o
+    inotify não enxerga gravações remotas): varre a pasta a cada `interval`
+    segundos e reporta arquivos novos ou com tamanho/mtime diferente.
+    """
+    kind = "polling"
+
+    def __init__(self, root: Path, pattern: str = "*.xml", recursive: bool = False,
+                 interval: float = WATCH_POLL_INTERVAL):
+        self.root = Path(root)
+        self.pattern = pattern
+        self.recursive = recursive
+        self.interval = interval
+        self.snapshot = self._scan()
+        self._next = time.monotonic() + interval
+
+    def _scan(self):
+        snap = {}
+        for p in iter_xmls(self.root, self.pattern, self.recursive):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            snap[p] = (st.st_size, st.st_mtime_ns)
+        return snap
+
+    def poll(self, timeout: float):
+        wait_s = self._next - time.monotonic()
+        if wait_s > timeout:
+            time.sleep(timeout)
+            return [], []
+        time.sleep(max(0.0, wait_s))
+        self._next = time.monotonic() + self.interval
+        snap = self._scan()
+        changed = [p for p, sig in snap.items() if self.snapshot.get(p) != sig]
+        self.snapshot = snap
+        return changed, []
+
+    def close(self):
+        pass
+
+def make_watcher(in_dir: Path, pattern: str, recursive: bool, poll: bool = False,
+                 interval: float = WATCH_POLL_INTERVAL, log_fn=None):
+    """inotify quando disponível; senão (ou com poll=True) varredura periódica."""
+    if not poll:
+        try:
+            return InotifyWatcher(in_dir, recursive)
+        except (OSError, AttributeError) as e:
+            if log_fn:
+                log_fn(f"[AVISO] inotify indisponível ({e}); usando varredura a cada {interval:g}s")
+    return PollingWatcher(in_dir, pattern, recursive, interval)
+
+def watch_directory(in_dir: Path, out_dir: Path, paper: str, glob: str = "*.xml", recursive: bool = False,
+                    log_fn=None, excel_path: Path | None = None, csv_path: Path | None = None,
+                    workers: int | None = None, font_regular=None, font_bold=None,
+                    debounce: float = WATCH_DEBOUNCE, poll: bool = False,
+                    poll_interval: float = WATCH_POLL_INTERVAL, max_queue: int | None = None,
+                    stop_event: threading.Event | None = None, escpos: int | None = None,
+                    layout: OutputLayout | None = None):
+    """
+    Monitora in_dir e converte cada XML novo ou alterado assim que ele fica
+    estável (sem eventos e com mtime parado há `debounce` segundos). No
+    início converte o que ficou pendente; o estado fica no manifesto
+    incremental (out_dir/nfce_manifest.jsonl), então reiniciar não reprocessa
+    nada. No máximo `max_queue` arquivos ficam em conversão ao mesmo tempo; o
+    resto espera na fila. As linhas vão para o CSV (acrescentadas e gravadas
+    a cada arquivo) e para o Excel (gravado ao encerrar); um XML alterado
+    depois de convertido é reconvertido, mas os itens de uma chave já
+    exportada não são repetidos. Roda até Ctrl+C /
+    SIGTERM ou até stop_event. Com escpos=N, grava .bin em ESC/POS em vez
+    de PDF; `layout` define subpastas e fsync (ver process_directory).
+    Retorna (ok, fail).
+    """
+    glob = glob or "*.xml"
+    layout = layout or DEFAULT_LAYOUT
+    sync = SyncBatch(layout.fsync)
+    workers = workers or default_workers()
+    max_queue = max_queue or workers * 2
+    stop_event = stop_event or threading.Event()
+    ensure_dir(out_dir)
+    manifest = Manifest(out_dir)
+    items = ItemsExport([excel_path, csv_path], log_fn=log_fn, append=True)
+    watcher = make_watcher(in_dir, glob, recursive, poll, poll_interval, log_fn)
+    pending = {}   # caminho -> instante do último evento (crescente: ordem de chegada)
+    inflight = {}  # future -> (caminho, stat)
+    ok, fail = 0, 0
+
+    def enqueue(p: Path, t: float):
+        pending.pop(p, None)
+        pending[p] = t
+
+    def enqueue_scan(d: Path):
+        for p in iter_xmls(d, glob, recursive):
+            if matches_pattern(p, in_dir, glob):
+                enqueue(p, time.monotonic())
+
+    def collect(done):
+        nonlocal ok, fail
+        for fut in done:
+            xp, st = inflight.pop(fut)
+            res = fut.result()
+            if res.error:
+                fail += 1
+                if log_fn:
+                    log_fn(f"[FALHA] {xp.name}: {res.error}")
+            else:
+                ok += 1
+                again = (res.chave in manifest.exported
+                         or manifest.entries.get(manifest.key(xp), {}).get("status") == "ok")
+                if again:
+                    res.rows = None  # os itens já estão no CSV/Excel
+                if log_fn:
+                    note = " (reconvertido: itens já exportados)" if again and items else ""
+                    log_fn(f"[OK] {xp.name} -> {res.out_pdf.name}{note}")
+                items.write(res.rows)
+                items.flush()
+                sync.add(res.out_pdf)
+            manifest.record(res, st)
+
+    enqueue_scan(in_dir)  # o que chegou com o watch parado
     if log_fn:
-        log_fn(f"[RESUMO] Sucesso: {ok} | Falhas: {fail} | Total: {total}")
-    return ok, fail, total
+        log_fn(f"[WATCH] Monitorando {in_dir} ({watcher.kind}, padrão: {glob}, recursivo: {recursive}); "
+               f"{len(pending)} XML(s) existentes a conferir. Ctrl+C para encerrar.")
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(font_regular, font_bold, XML_HUGE_TREE)) as ex:
+            try:
+                while not stop_event.is_set():
+                    files, rescan = watcher.poll(0.2 if (pending or inflight) else 1.0)
+                    now = time.monotonic()
+                    for p in files:
+                        if matches_pattern(p, in_dir, glob):
+                            enqueue(p, now)
+                    for d in rescan:
+                        enqueue_scan(d)
+
+                    # Fila limitada: só submete enquanto houver vaga
+                    wall = time.time()
+                    for p, t in list(pending.items()):
+                        if len(inflight) >= max_queue or now - t < debounce:
+                            break  # os seguintes são mais recentes
+                        del pending[p]
+                        try:
+                            st = p.stat()
+                        except OSError:
+                            continue  # removido antes de converter
+                        if wall - st.st_mtime < debounce:
+                            enqueue(p, now)  # ainda sendo gravado
+                            continue
+                        if manifest.is_current(p, st):
+                            continue
+                        fut = ex.submit(convert_file, p, out_dir, paper, bool(items), True,
+                                        escpos=escpos, layout=layout)
+                        inflight[fut] = (p, st)
+
+                    if inflight:
+                        done, _ = wait(list(inflight), timeout=0, return_when=FIRST_COMPLETED)
+                        collect(done)
+            except KeyboardInterrupt:
+                pass
+            # Encerramento: termina o que já foi submetido
+            if inflight:
+                collect(list(inflight))
+    finally:
+        sync.flush()
+        watcher.close()
+        manifest.close()
+        items.close()
+    if log_fn:
+        log_fn(f"[WATCH] Encerrado. Sucesso: {ok} | Falhas: {fail} | Pendentes na fila: {len(pending)}")
+    return ok, fail
+
+# =========================
+# Serviço HTTP local (--serve)
+# =========================
+
+SERVE_MAX_BODY = 50 * 1024 * 1024  # bytes por requisição
+SERVE_MAX_BATCH = 1000             # XMLs por requisição multipart
+SERVE_TIMEOUT = 120                # segundos por lote
+
+def render_job(xml_bytes: bytes, paper: str = "A4"):
+    """
+    Worker do serviço: renderiza um XML recebido pela rede.
+    Retorna (chave, pdf_bytes, erro). O XML vem de fora: o xml_parser()
+    não resolve entidades nem acessa a rede.
+    """
+    try:
+        doc = nfce_from_root(parse_xml(xml_bytes))
+        return doc.chave, render_pdf(doc, paper=paper), ""
+    except Exception as e:
+        return "", b"", str(e)
+
+def _warm_worker():
+    return os.getpid()
+
+def parse_multipart(content_type: str, body: bytes):
+    """Separa um corpo multipart/* em [(nome_do_arquivo, bytes)]."""
+    msg = BytesParser(policy=email_policy.HTTP).parsebytes(
+        b"Content-Type: " + content_type.encode("latin-1") + b"\r\n\r\n" + body
+    )
+    parts = []
+    for i, part in enumerate(msg.iter_parts(), start=1):
+        data = part.get_payload(decode=True)
+        if data:
+            parts.append((part.get_filename() or f"nfce_{i}.xml", data))
+    return parts
+
+class ServiceMetrics:
+    """Contadores do serviço (expostos em /metrics no formato texto do Prometheus)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}
+        self.pdfs = 0
+        self.render_errors = 0
+        self.rejected = 0
+        self.inflight = 0
+        self.render_seconds = 0.0
+
+    def inc(self, name: str, n=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def request_done(self, status: int):
+        with self._lock:
+            self.requests[status] = self.requests.get(status, 0) + 1
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                "# TYPE nfce_requests_total counter",
+                *[f'nfce_requests_total{{status="{st}"}} {n}' for st, n in sorted(self.requests.items())],
+                "# TYPE nfce_pdfs_total counter",
+                f"nfce_pdfs_total {self.pdfs}",
+                "# TYPE nfce_render_errors_total counter",
+                f"nfce_render_errors_total {self.render_errors}",
+                "# TYPE nfce_rejected_total counter",
+                f"nfce_rejected_total {self.rejected}",
+                "# TYPE nfce_inflight_requests gauge",
+                f"nfce_inflight_requests {self.inflight}",
+                "# TYPE nfce_render_seconds_total counter",
+                f"nfce_render_seconds_total {self.render_seconds:.6f}",
+                "# TYPE nfce_uptime_seconds gauge",
+                f"nfce_uptime_seconds {time.time() - self.started:.0f}",
+            ]
+        return "\n".join(lines) + "\n"
+
+class DanfeService:
+    """
+    Pool de processos aquecido (fontes registradas, cache de QR por worker)
+    e controle de concorrência: no máximo `max_pending` requisições em
+    andamento; acima disso a resposta é 503 com Retry-After.
+    """
+
+    def __init__(self, paper="A4", workers=None, font_regular=None, font_bold=None, max_pending=None):
+        self.paper = paper
+        self.workers = workers or default_workers()
+        self.max_pending = max_pending or self.workers * 4
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.metrics = ServiceMetrics()
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                        initargs=(font_regular, font_bold, XML_HUGE_TREE))
+        # Sobe todos os workers agora, para a 1ª requisição não pagar a partida
+        for f in [self.pool.submit(_warm_worker) for _ in range(self.workers)]:
+            f.result()
+
+    def render_many(self, blobs, paper):
+        t = time.perf_counter()
+        futures = [self.pool.submit(render_job, b, paper) for b in blobs]
+        results = [f.result(timeout=SERVE_TIMEOUT) for f in futures]
+        self.metrics.inc("render_seconds", time.perf_counter() - t)
+        ok = sum(1 for _, _, err in results if not err)
+        self.metrics.inc("pdfs", ok)
+        self.metrics.inc("render_errors", len(results) - ok)
+        return results
+
+    def close(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+class DanfeRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /danfe  corpo XML            -> application/pdf
+    POST /danfe  multipart (vários)   -> application/zip (um PDF por XML)
+    GET  /health                      -> JSON
+    GET  /metrics                     -> texto (Prometheus)
+    Parâmetro opcional: ?paper=A4|80mm
+    """
+    server_version = "NFCeDanfe/1.0"
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def service(self) -> DanfeService:
+        return self.server.service
+
+    def _send(self, status: int, body: bytes, ctype: str, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        self.service.metrics.request_done(status)
+
+    def _send_json(self, status: int, obj, headers=None):
+        self._send(status, json.dumps(obj, ensure_ascii=False).encode("utf-8"),
+                   "application/json; charset=utf-8", headers)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        svc = self.service
+        if path == "/health":
+            self._send_json(200, {"status": "ok", "workers": svc.workers,
+                                  "inflight": svc.metrics.inflight, "max_pending": svc.max_pending})
+        elif path == "/metrics":
+            self._send(200, svc.metrics.render().encode("utf-8"), "text/plain; version=0.0.4")
+        else:
+            self._send_json(404, {"erro": "não encontrado"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        svc = self.service
+        if url.path not in ("/", "/danfe"):
+            self._send_json(404, {"erro": "não encontrado"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            length = 0
+        if length <= 0:
+            self._send_json(411, {"erro": "Content-Length obrigatório"})
+            return
+        if length > SERVE_MAX_BODY:
+            self.close_connection = True
+            self._send_json(413, {"erro": f"corpo maior que {SERVE_MAX_BODY} bytes"})
+            return
+        # Backpressure: recusa na hora em vez de enfileirar sem limite
+        if not svc.slots.acquire(blocking=False):
+            svc.metrics.inc("rejected")
+            self.close_connection = True
+            self._send_json(503, {"erro": "serviço ocupado, tente novamente"}, {"Retry-After": "1"})
+            return
+        svc.metrics.inc("inflight")
+        try:
+            body = self.rfile.read(length)
+            paper = (parse_qs(url.query).get("paper") or [svc.paper])[0]
+            ctype = self.headers.get("Content-Type", "")
+            if ctype.lower().startswith("multipart/"):
+                self._post_batch(ctype, body, paper)
+            else:
+                self._post_single(body, paper)
+        except Exception as e:
+            self._send_json(500, {"erro": str(e)})
+        finally:
+            svc.metrics.inc("inflight", -1)
+            svc.slots.release()
+
+    def _post_single(self, body: bytes, paper: str):
+        chave, pdf, err = self.service.render_many([body], paper)[0]
+        if err:
+            self._send_json(400, {"erro": err})
+            return
+        self._send(200, pdf, "application/pdf",
+                   {"Content-Disposition": f'inline; filename="{chave or "danfe"}.pdf"'})
+
+    def _post_batch(self, ctype: str, body: bytes, paper: str):
+        parts = parse_multipart(ctype, body)
+        if not parts:
+            self._send_json(400, {"erro": "nenhum XML no multipart"})
+            return
+        if len(parts) > SERVE_MAX_BATCH:
+            self._send_json(413, {"erro": f"máximo de {SERVE_MAX_BATCH} XMLs por requisição"})
+            return
+        results = self.service.render_many([data for _, data in parts], paper)
+        buf = io.BytesIO()
+        names, falhas = set(), []
+        with zipfile.ZipFile(buf, "w", zipfile.ZIP_STORED) as zf:  # PDF já é comprimido
+            for (fname, _), (chave, pdf, err) in zip(parts, results):
+                if err:
+                    falhas.append(f"{fname}: {err}")
+                    continue
+                name = f"{chave or Path(fname).stem}.pdf"
+                k = 2
+                while name in names:
+                    name = f"{chave or Path(fname).stem}_{k}.pdf"
+                    k += 1
+                names.add(name)
+                zf.writestr(name, pdf)
+            if falhas:
+                zf.writestr("falhas.txt", "\n".join(falhas))
+        self._send(200, buf.getvalue(), "application/zip",
+                   {"Content-Disposition": 'attachment; filename="danfes.zip"',
+                    "X-NFCe-Ok": str(len(names)), "X-NFCe-Falhas": str(len(falhas))})
+
+    def log_message(self, format, *args):
+        log_fn = getattr(self.server, "log_fn", None)
+        if log_fn:
+            log_fn("[HTTP] " + (format % args))
+
+def serve(host="127.0.0.1", port=8765, paper="A4", workers=None, font_regular=None, font_bold=None,
+          max_pending=None, log_fn=None):
+    """Sobe o serviço HTTP local e atende até Ctrl+C."""
+    service = DanfeService(paper, workers, font_regular, font_bold, max_pending)
+    httpd = ThreadingHTTPServer((host, port), DanfeRequestHandler)
+    httpd.daemon_threads = True
+    httpd.service = service
+    httpd.log_fn = log_fn
+    if log_fn:
+        log_fn(f"Serviço DANFE em http://{host}:{httpd.server_port}/danfe "
+               f"({service.workers} worker(s), até {service.max_pending} requisições simultâneas)")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        service.close()
 
 # =========================
 # GUI
 # =========================
 
+GUI_POLL_MS = 100         # intervalo de atualização da tela
+GUI_LOG_LINES = 2000      # linhas mantidas no widget de log
+GUI_RATE_WINDOW = 10.0    # segundos usados no cálculo de vazão/ETA
+GUI_LOG_NAME = "nfce_conversao.log"
+
 class DanfeGUI:
     def __init__(self):
         self.root = tk.Tk()
@@ -538,6 +3290,9 @@ class DanfeGUI:
         self.var_paper = tk.StringVar(value="A4")
         self.var_recursive = tk.BooleanVar(value=False)
         self.var_glob = tk.StringVar(value="*.xml")
+        self.var_workers = tk.IntVar(value=default_workers())
+        self.var_incremental = tk.BooleanVar(value=False)
+        self.var_combine = tk.StringVar(value="")
 
         self.var_excel_enable = tk.BooleanVar(value=True)
         self.var_excel_path = tk.StringVar(value="")
@@ -569,6 +3324,11 @@ class DanfeGUI:
         ttk.Checkbutton(opt_frame, text="Buscar recursivamente em subpastas", variable=self.var_recursive).grid(row=0, column=3, sticky="w", padx=(12,0))
         ttk.Label(opt_frame, text="Padrão glob:").grid(row=0, column=4, sticky="e", padx=(12,4))
         ttk.Entry(opt_frame, textvariable=self.var_glob, width=12).grid(row=0, column=5, sticky="w")
+        ttk.Label(opt_frame, text="Processos:").grid(row=1, column=0, sticky="w", pady=(4,0))
+        ttk.Spinbox(opt_frame, from_=1, to=max(64, default_workers()), textvariable=self.var_workers, width=5).grid(row=1, column=1, sticky="w", pady=(4,0))
+        ttk.Checkbutton(opt_frame, text="Incremental (pular XMLs já convertidos)", variable=self.var_incremental).grid(row=1, column=3, sticky="w", padx=(12,0), pady=(4,0))
+        ttk.Label(opt_frame, text="PDF consolidado:").grid(row=1, column=4, sticky="e", padx=(12,4), pady=(4,0))
+        ttk.Combobox(opt_frame, textvariable=self.var_combine, values=("",) + COMBINE_MODES, width=8, state="readonly").grid(row=1, column=5, sticky="w", pady=(4,0))
 
         # Linha 4: Excel
         excel_frame = ttk.Frame(frm)
@@ -577,11 +3337,13 @@ class DanfeGUI:
         ttk.Entry(excel_frame, textvariable=self.var_excel_path, width=48).grid(row=0, column=1, sticky="ew", padx=(8,6))
         ttk.Button(excel_frame, text="Escolher…", command=self.pick_excel).grid(row=0, column=2, sticky="ew")
 
-        # Barra de progresso
+        # Barra de progresso + vazão/ETA
         self.progress = ttk.Progressbar(frm, mode="determinate", length=400)
-        self.progress.grid(row=6, column=0, columnspan=2, sticky="ew", pady=(8,4))
+        self.progress.grid(row=6, column=0, sticky="ew", pady=(8,4), padx=(0,6))
+        self.var_status = tk.StringVar(value="")
+        ttk.Label(frm, textvariable=self.var_status, width=36, anchor="e").grid(row=6, column=1, sticky="e", pady=(8,4))
 
-        # Log
+        # Log (só as últimas GUI_LOG_LINES linhas; o log completo vai para o disco)
         self.txt = tk.Text(frm, height=12, wrap="word")
         self.txt.grid(row=7, column=0, columnspan=2, sticky="nsew")
         frm.rowconfigure(7, weight=1)
@@ -589,8 +3351,19 @@ class DanfeGUI:
         # Botões
         btn_frame = ttk.Frame(frm)
         btn_frame.grid(row=8, column=0, columnspan=2, pady=(8,0), sticky="e")
-        ttk.Button(btn_frame, text="Converter", command=self.start_conversion).grid(row=0, column=0, padx=(0,6))
-        ttk.Button(btn_frame, text="Sair", command=self.root.destroy).grid(row=0, column=1)
+        self.btn_convert = ttk.Button(btn_frame, text="Converter", command=self.start_conversion)
+        self.btn_convert.grid(row=0, column=0, padx=(0,6))
+        self.btn_cancel = ttk.Button(btn_frame, text="Cancelar", command=self.cancel_conversion, state="disabled")
+        self.btn_cancel.grid(row=0, column=1, padx=(0,6))
+        ttk.Button(btn_frame, text="Sair", command=self.quit).grid(row=0, column=2)
+
+        # Comunicação worker -> UI: a thread de conversão nunca toca no Tk.
+        # Mensagens vão para a fila; o progresso é só o último (atual, total).
+        self.events = queue.SimpleQueue()
+        self._progress = None
+        self._rate = deque()  # amostras (instante, atual) para vazão/ETA
+        self.cancel_event = threading.Event()
+        self.worker = None
 
     def pick_in_dir(self):
         d = filedialog.askdirectory(title="Escolha o diretório com XML da NFC-e")
@@ -612,18 +3385,88 @@ class DanfeGUI:
             self.var_excel_path.set(f)
 
     def log(self, msg: str):
-        self.txt.insert("end", msg + "\n")
-        self.txt.see("end")
-        self.root.update_idletasks()
+        self.events.put(("log", msg))
 
     def set_progress(self, current, total):
-        if total <= 0:
-            self.progress["value"] = 0
-            self.progress["maximum"] = 1
-            return
-        self.progress["maximum"] = total
-        self.progress["value"] = current
-        self.root.update_idletasks()
+        self._progress = (current, total)
+
+    def poll_events(self):
+        """
+        Roda no loop do Tk a cada GUI_POLL_MS: drena a fila da thread de
+        conversão, acrescenta as linhas ao log de uma vez, corta o widget em
+        GUI_LOG_LINES e atualiza barra, vazão e ETA.
+        """
+        lines = deque(maxlen=GUI_LOG_LINES)
+        finished = None
+        try:
+            while True:
+                kind, msg = self.events.get_nowait()
+                if kind == "log":
+                    lines.append(msg)
+                else:
+                    finished = (kind, msg)
+        except queue.Empty:
+            pass
+        if lines:
+            self.txt.insert("end", "\n".join(lines) + "\n")
+            n = int(self.txt.index("end-1c").split(".")[0]) - 1
+            if n > GUI_LOG_LINES:
+                self.txt.delete("1.0", f"{n - GUI_LOG_LINES + 1}.0")
+            self.txt.see("end")
+        if self._progress is not None:
+            self._show_progress(*self._progress)
+        if finished is not None:
+            self._finish(*finished)
+        else:
+            self.root.after(GUI_POLL_MS, self.poll_events)
+
+    def _show_progress(self, current, total):
+        now = time.perf_counter()
+        self._rate.append((now, current))
+        while len(self._rate) > 2 and now - self._rate[0][0] > GUI_RATE_WINDOW:
+            self._rate.popleft()
+        t0, c0 = self._rate[0]
+        rate = (current - c0) / (now - t0) if now > t0 else 0.0
+        status = f"{current}" + (f"/{total}" if total is not None else "") + f" | {rate:,.1f} arq/s"
+        if total is None:
+            # total ainda desconhecido (varredura em andamento): barra indeterminada
+            if str(self.progress["mode"]) != "indeterminate":
+                self.progress.configure(mode="indeterminate")
+                self.progress.start(50)
+        else:
+            if str(self.progress["mode"]) != "determinate":
+                self.progress.stop()
+                self.progress.configure(mode="determinate")
+            self.progress["maximum"] = max(total, 1)
+            self.progress["value"] = current
+            if rate > 0 and total > current:
+                eta = int((total - current) / rate)
+                status += f" | ETA {eta // 3600:d}:{eta // 60 % 60:02d}:{eta % 60:02d}"
+        self.var_status.set(status)
+
+    def _finish(self, kind, msg):
+        if str(self.progress["mode"]) != "determinate":
+            self.progress.stop()
+            self.progress.configure(mode="determinate")
+        self.btn_convert.configure(state="normal")
+        self.btn_cancel.configure(state="disabled")
+        self.worker = None
+        if kind == "error":
+            messagebox.showerror("Erro", msg)
+        elif self.cancel_event.is_set():
+            messagebox.showwarning("Cancelado", msg)
+        else:
+            messagebox.showinfo("Concluído", msg)
+
+    def cancel_conversion(self):
+        if self.worker is not None:
+            self.cancel_event.set()
+            self.btn_cancel.configure(state="disabled")
+            self.log("[CANCELANDO] Aguardando os arquivos em andamento...")
+
+    def quit(self):
+        self.cancel_event.set()
+        self.root.destroy()
 
     def start_conversion(self):
         in_dir = Path(self.var_in_dir.get().strip())
@@ -631,6 +3474,12 @@ class DanfeGUI:
         paper = self.var_paper.get()
         recursive = bool(self.var_recursive.get())
         glob = self.var_glob.get().strip() or "*.xml"
+        try:
+            workers = max(1, int(self.var_workers.get()))
+        except Exception:
+            workers = default_workers()
+        incremental = bool(self.var_incremental.get())
+        combine = self.var_combine.get().strip() or None
 
         # Excel path (default se vazio)
         excel_path = None
@@ -653,28 +3502,56 @@ class DanfeGUI:
                 messagebox.showerror("Erro", f"Não foi possível criar o diretório de saída:\n{e}")
                 return
 
-        # roda em thread para não travar a GUI
-        th = threading.Thread(target=self._run_conversion, args=(in_dir, out_dir, paper, glob, recursive, excel_path), daemon=True)
-        th.start()
-
-    def _run_conversion(self, in_dir: Path, out_dir: Path, paper: str, glob: str, recursive: bool, excel_path: Path | None):
-        # reset UI
+        # reset UI (na thread do Tk, antes de iniciar a conversão)
         self.txt.delete("1.0", "end")
-        self.set_progress(0, 1)
+        self.progress.configure(mode="determinate", value=0, maximum=1)
+        self.var_status.set("")
+        self._progress = None
+        self._rate.clear()
+        self.cancel_event.clear()
+        self.btn_convert.configure(state="disabled")
+        self.btn_cancel.configure(state="normal")
+
+        # roda em thread para não travar a GUI; a UI acompanha por poll_events
+        self.worker = threading.Thread(target=self._run_conversion, args=(in_dir, out_dir, paper, glob, recursive, excel_path, workers, incremental, combine), daemon=True)
+        self.worker.start()
+        self.root.after(GUI_POLL_MS, self.poll_events)
+
+    def _run_conversion(self, in_dir: Path, out_dir: Path, paper: str, glob: str, recursive: bool, excel_path: Path | None,
+                        workers: int | None = None, incremental: bool = False, combine: str | None = None):
+        log_path = out_dir / GUI_LOG_NAME
         try:
-            def log_fn(m): self.log(m)
-            def progress_fn(cur, tot): self.set_progress(cur, tot)
-
+            log_file = open(log_path, "a", encoding="utf-8")
+        except OSError as e:
+            log_file = None
+            self.log(f"[AVISO] Sem log completo em disco ({e})")
+        try:
+            def log_fn(m):
+                if log_file is not None:
+                    log_file.write(m + "\n")
+                self.log(m)
+
+            if log_file is not None:
+                log_file.write(f"===== {datetime.now():%Y-%m-%d %H:%M:%S} {in_dir} =====\n")
+                self.log(f"Log completo em: {log_path}")
             ok, fail, total = process_directory(
                 in_dir, out_dir, paper=paper, glob=glob, recursive=recursive,
-                log_fn=log_fn, progress_fn=progress_fn, excel_path=excel_path
+                log_fn=log_fn, progress_fn=self.set_progress, excel_path=excel_path, workers=workers,
+                incremental=incremental, combine=combine, bookmarks=bool(combine), profile=True,
+                stop_event=self.cancel_event
             )
-            msg = f"Processo concluído. Sucesso: {ok} | Falhas: {fail} | Total: {total}"
-            self.log(msg)
-            messagebox.showinfo("Concluído", msg)
+            if self.cancel_event.is_set():
+                msg = f"Processo cancelado. Sucesso: {ok} | Falhas: {fail}"
+            else:
+                msg = f"Processo concluído. Sucesso: {ok} | Falhas: {fail} | Total: {total}"
+            log_fn(msg)
+            self.events.put(("done", msg))
         except Exception as e:
-            self.log(f"[ERRO] {e}")
-            messagebox.showerror("Erro", str(e))
+            log_fn(f"[ERRO] {e}")
+            self.events.put(("error", str(e)))
+        finally:
+            if log_file is not None:
+                log_file.close()
 
     def run(self):
         self.root.mainloop()
@@ -692,11 +3569,66 @@ def main():
     ap.add_argument("--paper", default="A4", help="A4 ou 80mm (padrão: A4)")
     ap.add_argument("--glob", default="*.xml", help="Padrão de busca quando entrada é diretório (padrão: *.xml)")
     ap.add_argument("--recursive", action="store_true", help="Buscar recursivamente em subpastas quando entrada é diretório")
+    ap.add_argument("--sorted", action="store_true", help="Varre o diretório inteiro antes e processa em ordem de nome (reprodutível)")
     ap.add_argument("--use-chave", action="store_true", help="(CLI) Nomear PDFs pela chave de acesso (se disponível)")
     ap.add_argument("--excel", help="Caminho do Excel de itens. Se omitido e 'saida' for diretório, salva em SAIDA/NFCe_itens.xlsx")
+    ap.add_argument("--workers", type=int, default=None, help="Processos em paralelo quando entrada é diretório (padrão: nº de núcleos)")
+    ap.add_argument("--csv", help="Exporta também os itens em CSV (streaming)")
+    ap.add_argument("--parquet", help="Exporta também os itens em Parquet (requer pyarrow)")
+    ap.add_argument("--combine", choices=COMBINE_MODES, help="Gera PDF consolidado: um por lote, por dia de emissão ou por CNPJ do emitente")
+    ap.add_argument("--bookmarks", action="store_true", help="(com --combine) Adiciona ao PDF uma entrada de sumário por chave")
+    ap.add_argument("--profile", nargs="?", const="", default=None, metavar="ARQ.jsonl",
+                    help="Mede o tempo por etapa (parse, layout, qr, save, excel); grava JSON lines em ARQ (padrão: SAIDA/nfce_profile.jsonl)")
+    ap.add_argument("--cprofile", metavar="ARQ.prof", help="Grava um dump do cProfile do lote (força --workers 1)")
+    ap.add_argument("--index", metavar="ARQ.sqlite", help="Grava cabeçalho e itens das notas convertidas num índice SQLite (para --query)")
+    ap.add_argument("--query", metavar="ARQ.sqlite", help="Consulta o índice (sem reler os XMLs); filtros: --from/--to/--cnpj/--min-value/--max-value/--product")
+    ap.add_argument("--from", dest="date_from", metavar="AAAA-MM-DD", help="(--query) Emitidas a partir desta data")
+    ap.add_argument("--to", dest="date_to", metavar="AAAA-MM-DD", help="(--query) Emitidas até esta data")
+    ap.add_argument("--cnpj", help="(--query) CNPJ do emitente")
+    ap.add_argument("--min-value", type=float, help="(--query) vNF mínimo")
+    ap.add_argument("--max-value", type=float, help="(--query) vNF máximo")
+    ap.add_argument("--product", metavar="CPROD", help="(--query) Notas que contêm este código de produto")
+    ap.add_argument("--items", action="store_true", help="(--query) Lista os itens em vez das notas")
+    ap.add_argument("--copy-pdfs", metavar="DIR", help="(--query) Copia os PDFs das notas encontradas para DIR")
+    ap.add_argument("--dedup", action="store_true", help="Converte uma única cópia por chave de acesso (prefere o nfeProc autorizado); duplicados vão para o resumo")
+    ap.add_argument("--incremental", action="store_true", help="Pular XMLs já convertidos e inalterados (manifesto em SAIDA/nfce_manifest.jsonl)")
+    ap.add_argument("--font", help="Arquivo TTF da fonte regular (padrão: DejaVuSans.ttf, se encontrado)")
+    ap.add_argument("--font-bold", help="Arquivo TTF da fonte negrito (padrão: <fonte>-Bold.ttf ao lado da regular)")
+    ap.add_argument("--escpos", action="store_true", help="Gera ESC/POS para impressora térmica em vez de PDF; 'saida' pode ser arquivo, dispositivo ou tcp://host[:9100]")
+    ap.add_argument("--escpos-columns", type=int, default=ESCPOS_COLUMNS, help=f"(--escpos) Colunas da bobina (padrão: {ESCPOS_COLUMNS}; 58mm: 32)")
+    ap.add_argument("--shard", choices=SHARD_MODES, help="Distribui os PDFs em subpastas: dia (AAAA/MM/DD), mes, ano, cnpj ou prefixo da chave (UF/AAMM)")
+    ap.add_argument("--fsync", type=int, default=0, metavar="N", help="Força os arquivos ao disco: 1 = cada arquivo antes do rename; N = em lotes de N (padrão: 0, o SO decide)")
+    ap.add_argument("--huge-tree", action="store_true", help="Libera os limites de tamanho do parser XML (cupons com dezenas de milhares de itens)")
+    ap.add_argument("--dry-run", action="store_true", help="Só lista os XMLs (chave, emissão, CNPJ, vNF) em CSV na saída padrão, sem gerar PDFs")
+    ap.add_argument("--watch", action="store_true", help="Monitora o diretório de entrada e converte cada XML novo/alterado (Ctrl+C encerra)")
+    ap.add_argument("--poll", action="store_true", help="(--watch) Usa varredura periódica em vez de inotify (ex.: pastas de rede)")
+    ap.add_argument("--debounce", type=float, default=WATCH_DEBOUNCE, help=f"(--watch) Segundos sem alteração antes de converter (padrão: {WATCH_DEBOUNCE:g})")
+    ap.add_argument("--serve", action="store_true", help="Sobe o serviço HTTP local de renderização (POST /danfe)")
+    ap.add_argument("--host", default="127.0.0.1", help="(--serve) Endereço de escuta (padrão: 127.0.0.1)")
+    ap.add_argument("--port", type=int, default=8765, help="(--serve) Porta (padrão: 8765)")
+    ap.add_argument("--max-pending", type=int, default=None, help="(--serve) Requisições simultâneas antes de responder 503 (padrão: 4 x workers)")
     ap.add_argument("--gui", action="store_true", help="Abrir interface gráfica")
 
     args = ap.parse_args()
+    configure_parser(args.huge_tree)
+
+    if args.query:
+        filters = dict(date_from=args.date_from, date_to=args.date_to, cnpj=args.cnpj,
+                       min_value=args.min_value, max_value=args.max_value, product=args.product)
+        try:
+            query_index(Path(args.query), filters,
+                        items_paths=[Path(p) for p in (args.excel, args.csv, args.parquet) if p],
+                        copy_pdfs=Path(args.copy_pdfs) if args.copy_pdfs else None,
+                        list_items=args.items, log_fn=lambda m: print(m, file=sys.stderr))
+        except (OSError, sqlite3.Error) as e:
+            print(f"[ERRO] {e}", file=sys.stderr)
+            sys.exit(2)
+        return
+
+    if args.serve:
+        serve(args.host, args.port, paper=args.paper, workers=args.workers, font_regular=args.font,
+              font_bold=args.font_bold, max_pending=args.max_pending, log_fn=print)
+        return
 
     # Se GUI foi pedida (ou nenhum argumento passado), abre GUI
     if args.gui or (args.entrada is None and args.saida is None):
@@ -707,9 +3639,22 @@ def main():
         app.run()
         return
 
+    configure_fonts(args.font, args.font_bold)
+    try:
+        get_fonts()
+    except RuntimeError as e:
+        print(f"[ERRO] {e}", file=sys.stderr)
+        sys.exit(2)
+
     entrada = Path(args.entrada) if args.entrada else None
     saida = Path(args.saida) if args.saida else None
 
+    if args.dry_run and entrada is not None:
+        # não precisa de 'saida': só lê os metadados
+        _, fail = dry_run(entrada, glob=args.glob, recursive=args.recursive, sort=args.sorted,
+                          workers=args.workers, log_fn=lambda m: print(m, file=sys.stderr))
+        sys.exit(1 if fail else 0)
+
     if entrada is None or saida is None:
         print("Uso (CLI): python danfe_nfce_pdf.py <entrada> <saida> [--paper A4|80mm] [--glob '*.xml'] [--recursive] [--use-chave] [--excel caminho.xlsx]", file=sys.stderr)
         sys.exit(2)
@@ -718,42 +3663,116 @@ def main():
     excel_path = None
     if args.excel:
         excel_path = Path(args.excel)
-    elif entrada.is_dir() and (not saida.suffix.lower() == ".pdf"):
+    elif saida.suffix.lower() == ".zip" and (entrada.is_dir() or is_archive(entrada)):
+        # saída em .zip: planilha ao lado (SAIDA_itens.xlsx)
+        excel_path = saida.with_name(f"{saida.stem}_itens.xlsx")
+    elif (entrada.is_dir() or is_archive(entrada)) and (not saida.suffix.lower() == ".pdf"):
         # padrão: SAIDA/NFCe_itens.xlsx
         excel_path = saida / "NFCe_itens.xlsx"
 
-    # CLI: arquivo único ou diretório
-    if entrada.is_dir():
+    layout = OutputLayout(shard=args.shard, fsync=max(0, args.fsync))
+
+    # CLI: arquivo único, diretório ou arquivo compactado (.zip/.tar*)
+    if entrada.is_dir() or (entrada.is_file() and is_archive(entrada)):
         if saida.suffix.lower() == ".pdf":
             print("[ERRO] Para entrada em diretório, 'saida' deve ser um diretório (e não .pdf).", file=sys.stderr)
             sys.exit(2)
+        if saida.suffix.lower() == ".zip" and (args.combine or args.watch):
+            print("[ERRO] --combine e --watch precisam de um diretório de saída (e não .zip).", file=sys.stderr)
+            sys.exit(2)
+        if args.watch and not entrada.is_dir():
+            print("[ERRO] --watch monitora um diretório; a entrada não pode ser um arquivo compactado.", file=sys.stderr)
+            sys.exit(2)
+        if args.watch:
+            if args.parquet or args.combine:
+                print("[AVISO] --parquet e --combine não se aplicam ao --watch; ignorados.", file=sys.stderr)
+            stop = threading.Event()
+            signal.signal(signal.SIGTERM, lambda *_: stop.set())
+            watch_directory(
+                entrada, saida, paper=args.paper, glob=args.glob, recursive=args.recursive, log_fn=print,
+                excel_path=excel_path, csv_path=Path(args.csv) if args.csv else None,
+                workers=args.workers, font_regular=args.font, font_bold=args.font_bold,
+                debounce=args.debounce, poll=args.poll, stop_event=stop,
+                escpos=args.escpos_columns if args.escpos else None, layout=layout
+            )
+            return
+        workers = args.workers
+        profile_path = None
+        if args.profile is not None:
+            profile_dir = saida.parent if saida.suffix.lower() == ".zip" else saida
+            profile_path = Path(args.profile) if args.profile else profile_dir / "nfce_profile.jsonl"
+        profiler = None
+        if args.cprofile:
+            import cProfile
+            workers = 1  # o cProfile só enxerga o processo atual
+            profiler = cProfile.Profile()
+            profiler.enable()
         process_directory(
             entrada, saida, paper=args.paper, glob=args.glob, recursive=args.recursive,
-            excel_path=excel_path
+            log_fn=print,
+            excel_path=excel_path, workers=workers,
+            font_regular=args.font, font_bold=args.font_bold, incremental=args.incremental,
+            csv_path=Path(args.csv) if args.csv else None,
+            parquet_path=Path(args.parquet) if args.parquet else None,
+            combine=args.combine, bookmarks=args.bookmarks, sort=args.sorted,
+            profile_path=profile_path, dedup=args.dedup,
+            index_path=Path(args.index) if args.index else None,
+            escpos=args.escpos_columns if args.escpos else None, layout=layout
         )
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+            print(f"cProfile salvo em {args.cprofile}")
+    elif entrada.is_file() and args.escpos:
+        # ESC/POS: 'saida' é arquivo, dispositivo (/dev/usb/lp0) ou tcp://host:porta;
+        # num diretório existente, grava <nome>.bin
+        doc = load_nfce(entrada)
+        dest = args.saida
+        if saida.is_dir():
+            dest = str(saida / f"{(doc.chave if args.use_chave else '') or entrada.stem}.bin")
+        try:
+            send_escpos(render_escpos(doc, columns=args.escpos_columns), dest)
+        except OSError as e:
+            print(f"[ERRO] ESC/POS: {e}", file=sys.stderr)
+            sys.exit(1)
+        print(f"OK: ESC/POS enviado para {dest}")
+        for items_path in (excel_path, args.csv, args.parquet):
+            if items_path is None:
+                continue
+            try:
+                export_excel(excel_rows(doc), Path(items_path))
+            except Exception as ee:
+                print(f"[ERRO EXCEL] {ee}", file=sys.stderr)
     elif entrada.is_file():
         # Se saída for arquivo .pdf, gera PDF com esse nome; Excel (se solicitado) terá apenas os itens desse XML.
+        doc = load_nfce(entrada)
         if saida.suffix.lower() == ".pdf":
-            make_pdf(str(entrada), str(saida), paper=args.paper)
+            with atomic_output(saida, fsync=layout.fsync > 0) as tmp:
+                make_pdf(doc, str(tmp), paper=args.paper)
             print(f"OK: PDF gerado em {saida}")
-            if excel_path is not None:
+            for items_path in (excel_path, args.csv, args.parquet):
+                if items_path is None:
+                    continue
                 try:
-                    rows = parse_items_for_excel(entrada)
-                    export_excel(rows, excel_path)
+                    rows = excel_rows(doc)
+                    export_excel(rows, Path(items_path))
                 except Exception as ee:
                     print(f"[ERRO EXCEL] {ee}", file=sys.stderr)
         else:
             ensure_dir(saida)
             if args.use_chave:
-                out_pdf = saida / f"{extract_chave_from_file(entrada) or entrada.stem}.pdf"
+                out_pdf = saida / f"{doc.chave or entrada.stem}.pdf"
             else:
                 out_pdf = saida / f"{entrada.stem}.pdf"
-            make_pdf(str(entrada), str(out_pdf), paper=args.paper)
+            with atomic_output(out_pdf, fsync=layout.fsync > 0) as tmp:
+                make_pdf(doc, str(tmp), paper=args.paper)
             print(f"OK: PDF gerado em {out_pdf}")
-            if excel_path is not None:
+            for items_path in (excel_path, args.csv, args.parquet):
+                if items_path is None:
+                    continue
                 try:
-                    rows = parse_items_for_excel(entrada)
-                    export_excel(rows, excel_path)
+                    rows = excel_rows(doc)
+                    export_excel(rows, Path(items_path))
                 except Exception as ee:
                     print(f"[ERRO EXCEL] {ee}", file=sys.stderr)
     else:
@@ -761,4 +3780,6 @@ def main():
         sys.exit(2)
 
 if __name__ == "__main__":
+    import multiprocessing
+    multiprocessing.freeze_support()  # executável congelado (PyInstaller) no Windows
     main()
@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+FIXTURES = Path(__file__).resolve().parent / "fixtures"
+sys.path.insert(0, str(ROOT))
+
+CHAVE = "35250712345678000199650010000012341000012345"
+
+@pytest.fixture
+def nfce_xml() -> Path:
+    return FIXTURES / "nfce_80mm.xml"
+
+@pytest.fixture
+def xml_dir(tmp_path, nfce_xml):
+    """Pasta com `n` cópias do XML de exemplo, cada uma com uma chave diferente."""
+    def make(n=3):
+        d = tmp_path / "xml"
+        d.mkdir(exist_ok=True)
+        text = nfce_xml.read_text(encoding="utf-8")
+        for i in range(n):
+            chave = CHAVE[:-4] + f"{i:04d}"
+            (d / f"nfce_{i}.xml").write_text(text.replace(CHAVE, chave), encoding="utf-8")
+        return d
+    return make
@@ -0,0 +1,98 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import nfce_grafico as nf
+
+# -------------------------
+# Gravação em disco (--fsync)
+# -------------------------
+
+@pytest.mark.parametrize("every", [1, 2])
+def test_combine_honors_fsync(tmp_path, xml_dir, monkeypatch, every):
+    synced = []
+    monkeypatch.setattr(nf, "fsync_path", lambda p: synced.append(Path(p).name))
+    out = tmp_path / "out"
+    ok, fail, _ = nf.process_directory(xml_dir(3), out, "80mm", "*.xml", False, workers=1,
+                                       combine="lote", layout=nf.OutputLayout(fsync=every))
+    assert (ok, fail) == (3, 0)
+    assert (out / "NFCe_lote.pdf").exists()
+    assert any(name.startswith("NFCe_lote.pdf") for name in synced)
+
+# -------------------------
+# Fontes
+# -------------------------
+
+def test_pool_map_in_process_keeps_configured_fonts(tmp_path):
+    try:
+        ttf = Path(nf.TTFont("_probe", nf.DEFAULT_FONT).face.filename)
+    except Exception:
+        pytest.skip(f"{nf.DEFAULT_FONT} não encontrada")
+    font = tmp_path / "Minha.ttf"
+    font.write_bytes(ttf.read_bytes())
+    nf.configure_fonts(font)
+    try:
+        regular, _ = nf.get_fonts()
+        assert regular.startswith("Minha-")
+        assert list(nf.pool_map(str, [1, 2], workers=1)) == ["1", "2"]
+        assert nf.get_fonts()[0] == regular
+    finally:
+        nf.configure_fonts()
+
+# -------------------------
+# Metadados (--dry-run)
+# -------------------------
+
+def test_read_meta_stream_matches_tree(nfce_xml, monkeypatch):
+    tree = nf.read_meta(nfce_xml, totals=True)
+    assert tree.chave == "35250712345678000199650010000012341000012345"
+    assert str(tree.vNF) == "25.00" and tree.proc
+    monkeypatch.setattr(nf, "META_STREAM_MIN", 0)  # força o parse incremental
+    assert nf.read_meta(nfce_xml, totals=True) == tree
+    assert nf.read_meta(nfce_xml.read_bytes(), totals=True) == tree
+
+# -------------------------
+# ESC/POS
+# -------------------------
+
+def test_escpos_golden_bytes(nfce_xml):
+    expected = nfce_xml.with_suffix(".bin").read_bytes()
+    data = nf.render_escpos(nf.load_nfce(nfce_xml))
+    assert data == expected
+    # partes do fluxo conferidas à parte, para um diff legível se o layout mudar
+    assert data.startswith(b"\x1b@\x1bt\x03")               # ESC @, ESC t 3 (PC860)
+    assert "SÃO JOÃO".encode("cp860") in data
+    assert b"\x1d(k\x04\x001A2\x00" in data                  # GS ( k: QR modelo 2
+    assert b"\x1d(k\x03\x001Q0" in data                      # GS ( k: imprime o QR
+    assert data.endswith(b"\x1bd\x04\x1dV\x01")              # avança e corta
+
+def test_escpos_single_file_cli_writes_items(tmp_path, nfce_xml):
+    out, items = tmp_path / "cupom.bin", tmp_path / "itens.csv"
+    proc = subprocess.run([sys.executable, nf.__file__, str(nfce_xml), str(out), "--escpos", "--csv", str(items)],
+                          capture_output=True, text=True)
+    assert proc.returncode == 0, proc.stderr
+    assert out.read_bytes() == nfce_xml.with_suffix(".bin").read_bytes()
+    assert len(items.read_text(encoding="utf-8").splitlines()) == 1 + 3
+
+# -------------------------
+# Modo incremental
+# -------------------------
+
+def test_incremental_reconversion_does_not_duplicate_rows(tmp_path, xml_dir):
+    src, out = xml_dir(3), tmp_path / "out"
+    csv_path = out / "itens.csv"
+
+    def run():
+        return nf.process_directory(src, out, "80mm", "*.xml", False, workers=1, incremental=True,
+                                    csv_path=csv_path)
+
+    assert run()[:2] == (3, 0)
+    rows = csv_path.read_text(encoding="utf-8").splitlines()
+    assert len(rows) == 1 + 3 * 3
+    changed = src / "nfce_1.xml"
+    changed.write_text(changed.read_text(encoding="utf-8").replace("CONSUMIDOR TESTE", "OUTRO NOME"),
+                       encoding="utf-8")
+    assert run()[:2] == (1, 0)
+    assert csv_path.read_text(encoding="utf-8").splitlines() == rows